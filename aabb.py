@@ -1,5 +1,4 @@
-from OpenGL.GL import glCallList, glMatrixMode, glPolygonMode, glPopMatrix, glPushMatrix, glTranslated, \
-                      GL_FILL, GL_FRONT_AND_BACK, GL_LINE, GL_MODELVIEW
+from backend import GL
 from primitive import G_OBJ_CUBE
 import numpy
 import math
@@ -18,7 +17,8 @@ class AABB(object):
         self.size = numpy.array(size)
 
     def scale(self, scale):
-        self.size *= scale
+        self.center = self.center * scale
+        self.size = self.size * scale
 
     def ray_hit(self, origin, direction, modelmatrix):
         """ Returns True <=> the ray hits the AABB
@@ -94,10 +94,10 @@ class AABB(object):
 
     def render(self):
         """ render the AABB. This can be useful for debugging purposes """
-        glPolygonMode(GL_FRONT_AND_BACK, GL_LINE)
-        glMatrixMode(GL_MODELVIEW)
-        glPushMatrix()
-        glTranslated(self.center[0], self.center[1], self.center[2])
-        glCallList(G_OBJ_CUBE)
-        glPopMatrix()
-        glPolygonMode(GL_FRONT_AND_BACK, GL_FILL)
\ No newline at end of file
+        GL.glPolygonMode(GL.GL_FRONT_AND_BACK, GL.GL_LINE)
+        GL.glMatrixMode(GL.GL_MODELVIEW)
+        GL.glPushMatrix()
+        GL.glTranslated(self.center[0], self.center[1], self.center[2])
+        GL.glCallList(G_OBJ_CUBE)
+        GL.glPopMatrix()
+        GL.glPolygonMode(GL.GL_FRONT_AND_BACK, GL.GL_FILL)
\ No newline at end of file
@@ -0,0 +1,30 @@
+"""
+Lazy access to the rendering backend.
+
+The scene graph, the math and picking only need NumPy. PyOpenGL is imported
+the first time one of its functions is looked up, so batch tools that never
+draw do not pay its import cost and run without a display stack.
+"""
+import importlib
+
+
+class LazyModule(object):
+    """ Stands in for a module and imports it on first attribute access """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        value = getattr(importlib.import_module(self._name), attr)
+        # later lookups find the attribute without going through here
+        setattr(self, attr, value)
+        return value
+
+    def loaded(self):
+        """ Whether the real module has been imported """
+        return len(self.__dict__) > 1
+
+
+GL = LazyModule('OpenGL.GL')
+GLU = LazyModule('OpenGL.GLU')
+GLUT = LazyModule('OpenGL.GLUT')
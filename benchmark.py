@@ -0,0 +1,352 @@
+"""
+Micro-benchmarks of the math and picking hot paths.
+
+Runs without a display. Every case is timed over a number of samples, each
+sample long enough for the clock to be trusted, and its memory allocation
+per call is measured with tracemalloc. Results can be stored as a JSON
+baseline and two baselines compared, a case counts as regressed only when
+a Mann-Whitney U test finds the new samples significantly slower.
+
+    python benchmark.py run [--out baseline.json] [--filter pick] [--quick]
+    python benchmark.py compare baseline.json new.json
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy
+
+import scatter
+import transformation
+import trackball
+from aabb import AABB
+from node import Cube, HierarchicalNode, Sphere
+from scene import Scene
+
+# version of the baseline file layout
+FORMAT = 1
+SAMPLES = 20
+# seconds one sample should last at least
+SAMPLE_TIME = 0.005
+# calls averaged by the allocation measurement
+ALLOCATION_CALLS = 5
+
+SCENE_SIZES = [10, 100, 1000, 10000]
+HIERARCHY_DEPTHS = [1, 4, 16]
+DRAG_LENGTHS = [10, 100, 1000]
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+VIEWPORT = (0, 0, 640, 480)
+# a ray from the eye straight down the view axis, as Viewer.get_ray makes it
+RAY_START = numpy.array([0.0, 0.0, 14.9])
+RAY_DIRECTION = numpy.array([0.0, 0.0, -1.0])
+
+
+def sample_scene(count, seed=0):
+    """ A scene of count spheres and cubes spread around the view axis """
+    rng = numpy.random.default_rng(seed)
+    scene = Scene()
+    for i in range(count):
+        node = Sphere() if i % 2 else Cube()
+        node.translate(*rng.uniform(-10.0, 10.0, 3))
+        scene.add_node(node)
+    # one node on the ray, so every pick hits
+    target = Cube()
+    scene.add_node(target)
+    return scene, target
+
+
+def nested(depth):
+    """ A chain of depth assemblies with a cube at the bottom """
+    root = node = HierarchicalNode()
+    for level in range(depth):
+        child = HierarchicalNode() if level < depth - 1 else Cube()
+        node.add_child(child)
+        # a sibling at every level the ray misses
+        decoy = Sphere()
+        decoy.translate(5.0, 0.0, 0.0)
+        node.add_child(decoy)
+        node = child
+    return root
+
+
+def case_ray_hit():
+    aabb = AABB([0.0, 0.0, 0.0], [0.5, 0.5, 0.5])
+    mat = numpy.identity(4)
+    return lambda: aabb.ray_hit(RAY_START, RAY_DIRECTION, mat)
+
+
+def case_node_pick():
+    node = Cube()
+    mat = numpy.identity(4)
+    return lambda: node.pick(RAY_START, RAY_DIRECTION, mat)
+
+
+def case_pick_path(depth):
+    root = nested(depth)
+    mat = numpy.identity(4)
+    return lambda: root.pick_path(RAY_START, RAY_DIRECTION, mat)
+
+
+def case_scaling():
+    return lambda: transformation.scaling([1.5, 1.5, 1.5])
+
+
+def case_translation():
+    return lambda: transformation.translation([1.0, 2.0, 3.0])
+
+
+def case_drag(length):
+    ball = trackball.Trackball(theta=-25, distance=15)
+    path = [(320 + 200 * math.cos(t), 240 + 200 * math.sin(t))
+            for t in numpy.linspace(0.0, 2.0 * math.pi, length + 1)]
+
+    def drag():
+        for (x0, y0), (x1, y1) in zip(path, path[1:]):
+            ball.drag_to(x0, y0, x1 - x0, y1 - y0, VIEWPORT)
+    return drag
+
+
+def case_rotate():
+    ball = trackball.Trackball(theta=-25, distance=15)
+    return lambda: ball._rotate(0.1, 0.2, 0.01, -0.02)
+
+
+def case_rotmatrix():
+    q = trackball._q_from_axis_angle([0.3, 0.5, 0.8], 0.7)
+    return lambda: trackball._q_rotmatrix(q)
+
+
+def case_scene_pick(count):
+    scene, target = sample_scene(count)
+    mat = numpy.identity(4)
+    return lambda: scene.pick(RAY_START, RAY_DIRECTION, mat)
+
+
+def case_move_selected(count):
+    scene, target = sample_scene(count)
+    mat = numpy.identity(4)
+    scene.pick(RAY_START, RAY_DIRECTION, mat)
+    directions = [numpy.array([0.01, 0.0, -1.0]), numpy.array([-0.01, 0.0, -1.0])]
+    directions = [d / numpy.linalg.norm(d) for d in directions]
+    calls = [0]
+
+    def move():
+        calls[0] += 1
+        scene.move_selected(RAY_START, directions[calls[0] % 2], mat)
+    return move
+
+
+def case_place(count):
+    scene, target = sample_scene(count)
+    mat = numpy.identity(4)
+
+    def place():
+        scene.place('sphere', RAY_START, RAY_DIRECTION, mat)
+
+    def reset():
+        # take the node out again, so every call places into the same scene
+        node = scene.node_list[-1]
+        scene.remove_node(node)
+        scene.removed.discard(node.node_id)
+    return place, reset
+
+
+def case_build_nodes(count):
+    template = Cube()
+    locations = numpy.random.default_rng(0).uniform(-10.0, 10.0, (count, 3))
+    return lambda: scatter.build_nodes(template, locations)
+
+
+def cases():
+    """
+    Return (name, setup) of every case. setup builds the function timed, or
+    (function, reset) where reset undoes each call and is not timed.
+    """
+    yield 'aabb.ray_hit', case_ray_hit
+    yield 'node.pick', case_node_pick
+    for depth in HIERARCHY_DEPTHS:
+        yield f'node.pick_path[depth={depth}]', lambda depth=depth: case_pick_path(depth)
+    yield 'transformation.scaling', case_scaling
+    yield 'transformation.translation', case_translation
+    for length in DRAG_LENGTHS:
+        yield f'trackball.drag_to[path={length}]', lambda length=length: case_drag(length)
+    yield 'trackball._rotate', case_rotate
+    yield 'trackball._q_rotmatrix', case_rotmatrix
+    for count in SCENE_SIZES:
+        yield f'scene.pick[nodes={count}]', lambda count=count: case_scene_pick(count)
+        yield f'scene.move_selected[nodes={count}]', lambda count=count: case_move_selected(count)
+        yield f'scene.place[nodes={count}]', lambda count=count: case_place(count)
+        yield f'scatter.build_nodes[nodes={count}]', lambda count=count: case_build_nodes(count)
+
+
+def timed(function, reset, loops):
+    """ Seconds loops calls of function take, with reset run untimed after each """
+    if reset is None:
+        start = time.perf_counter()
+        for _ in range(loops):
+            function()
+        return time.perf_counter() - start
+    total = 0.0
+    for _ in range(loops):
+        start = time.perf_counter()
+        function()
+        total += time.perf_counter() - start
+        reset()
+    return total
+
+
+def calibrate(function, reset=None):
+    """ The number of calls making one sample last SAMPLE_TIME """
+    loops = 1
+    while True:
+        if timed(function, reset, loops) >= SAMPLE_TIME:
+            return loops
+        loops *= 2
+
+
+def measure(function, samples, reset=None):
+    """ Return (seconds per call of every sample, allocation per call) """
+    loops = calibrate(function, reset)
+    times = []
+    for _ in range(samples):
+        times.append(timed(function, reset, loops) / loops)
+
+    tracemalloc.start()
+    try:
+        peak = retained = 0
+        for _ in range(ALLOCATION_CALLS):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            function()
+            current, highest = tracemalloc.get_traced_memory()
+            peak += highest - before
+            retained += current - before
+            if reset is not None:
+                reset()
+    finally:
+        tracemalloc.stop()
+    allocation = dict(peak=peak // ALLOCATION_CALLS, retained=retained // ALLOCATION_CALLS)
+    return times, allocation
+
+
+def revision():
+    """ The git commit being measured, or None outside a checkout """
+    try:
+        output = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.strip()
+
+
+def run(args):
+    samples = 5 if args.quick else args.samples
+    results = dict()
+    with open(os.devnull, 'w') as devnull:
+        for name, setup in cases():
+            if args.filter and args.filter not in name:
+                continue
+            # the scene prints on every change
+            with contextlib.redirect_stdout(devnull):
+                case = setup()
+                function, reset = case if isinstance(case, tuple) else (case, None)
+                times, allocation = measure(function, samples, reset)
+            results[name] = dict(samples=times, allocation=allocation)
+            median = numpy.median(times) * 1e6
+            print(f"{name:36} {median:12.2f} us  peak {allocation['peak']:9d} B  "
+                  f"retained {allocation['retained']:8d} B", flush=True)
+
+    if args.out:
+        baseline = dict(format=FORMAT, revision=revision(),
+                        created=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                        python=platform.python_version(), numpy=numpy.__version__,
+                        machine=platform.machine(), results=results)
+        with open(args.out, 'w') as f:
+            json.dump(baseline, f, indent=1)
+        print(f"wrote {args.out}")
+
+
+def mann_whitney_greater(a, b):
+    """
+    One sided Mann-Whitney U test, the p-value of b being no larger than a.
+    Uses the normal approximation with the correction for ties.
+    """
+    a, b = numpy.asarray(a), numpy.asarray(b)
+    n1, n2 = len(a), len(b)
+    values = numpy.concatenate((a, b))
+    order = numpy.argsort(values, kind='mergesort')
+    ranks = numpy.empty(len(values))
+    ranks[order] = numpy.arange(1, len(values) + 1)
+    # tied values share their average rank
+    unique, inverse, counts = numpy.unique(values, return_inverse=True, return_counts=True)
+    ranks = (numpy.bincount(inverse, weights=ranks) / counts)[inverse]
+    u = ranks[n1:].sum() - n2 * (n2 + 1) / 2.0
+    n = n1 + n2
+    variance = n1 * n2 / 12.0 * ((n + 1) - (counts ** 3 - counts).sum() / (n * (n - 1)))
+    if variance <= 0:
+        return 1.0
+    z = (u - n1 * n2 / 2.0 - 0.5) / math.sqrt(variance)
+    return 0.5 * math.erfc(z / math.sqrt(2.0))
+
+
+def compare(args):
+    baselines = []
+    for path in (args.base, args.new):
+        with open(path) as f:
+            baseline = json.load(f)
+        if baseline.get('format') != FORMAT:
+            sys.exit(f"{path} has baseline format {baseline.get('format')}, expected {FORMAT}")
+        baselines.append(baseline)
+    base, new = baselines
+    print(f"base {base['revision']} {base['created']}  new {new['revision']} {new['created']}")
+
+    regressions = 0
+    for name, result in new['results'].items():
+        if name not in base['results']:
+            print(f"{name:36} new case")
+            continue
+        before = base['results'][name]
+        change = numpy.median(result['samples']) / numpy.median(before['samples']) - 1.0
+        p = mann_whitney_greater(before['samples'], result['samples'])
+        regressed = p < args.alpha and change > args.threshold
+        regressions += regressed
+        allocation = result['allocation']['peak'] - before['allocation']['peak']
+        print(f"{name:36} {change * 100.0:+7.1f} %  p {p:.4f}  "
+              f"peak {allocation:+9d} B{'  REGRESSION' if regressed else ''}")
+    print(f"{regressions} regressions")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the hot paths")
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help="time every case")
+    run_parser.add_argument('--out', metavar='FILE', help="store the results as a baseline")
+    run_parser.add_argument('--filter', help="only run cases whose name contains this")
+    run_parser.add_argument('--samples', type=int, default=SAMPLES)
+    run_parser.add_argument('--quick', action='store_true', help="few samples, for a smoke test")
+    compare_parser = commands.add_parser('compare', help="flag regressions between baselines")
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--alpha', type=float, default=0.01,
+                                help="significance level of the test")
+    compare_parser.add_argument('--threshold', type=float, default=0.05,
+                                help="smallest slowdown of the median worth reporting")
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Event bus between input handling, the scene and background workers.
+
+Light events (moves, keystrokes) are published and handled straight away on
+the thread that owns the scene. Heavy queries are submitted to a thread pool
+and their results are queued until drain() hands them back on the scene
+thread. A query submitted under a name supersedes every earlier one of that
+name: the earlier ones are skipped if not started yet and their results are
+dropped otherwise, so feedback always matches the latest input.
+"""
+import queue
+import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class EventBus(object):
+
+    def __init__(self, workers=2):
+        # subscribers of each event name
+        self.subscribers = defaultdict(list)
+        # with no workers queries run inline, which keeps replays deterministic
+        self.workers = workers
+        self.executor = None
+        self.results = queue.Queue()
+        # generation of the newest query of each name
+        self.latest = defaultdict(int)
+        self.stats = dict(submitted=0, delivered=0, dropped=0, failed=0)
+
+    def subscribe(self, name, function):
+        self.subscribers[name].append(function)
+
+    def publish(self, name, *args, **kwargs):
+        for function in self.subscribers[name]:
+            function(*args, **kwargs)
+
+    def submit(self, name, query, on_result, *args):
+        """
+        Run query(*args) in the background, then on_result(result) on the
+        thread calling drain(), unless a newer query of the same name came in.
+        """
+        self.latest[name] += 1
+        generation = self.latest[name]
+        self.stats['submitted'] += 1
+        if not self.workers:
+            self.run(name, generation, query, on_result, args)
+            self.drain()
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='query')
+        self.executor.submit(self.run, name, generation, query, on_result, args)
+
+    def run(self, name, generation, query, on_result, args):
+        if self.latest[name] != generation:
+            self.results.put((name, generation, on_result, None, None))
+            return
+        try:
+            self.results.put((name, generation, on_result, query(*args), None))
+        except Exception as error:
+            # reported by drain() on the thread that owns the scene
+            self.results.put((name, generation, on_result, None, error))
+
+    def drain(self):
+        """ Deliver finished query results, return how many were delivered """
+        delivered = 0
+        while True:
+            try:
+                name, generation, on_result, result, error = self.results.get_nowait()
+            except queue.Empty:
+                return delivered
+            if self.latest[name] != generation:
+                self.stats['dropped'] += 1
+                continue
+            if error is not None:
+                # a failed query leaves its result out, the others still arrive
+                print(f"query {name} failed")
+                traceback.print_exception(error)
+                self.stats['failed'] += 1
+                continue
+            on_result(result)
+            self.stats['delivered'] += 1
+            delivered += 1
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
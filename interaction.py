@@ -1,12 +1,13 @@
-from collections import defaultdict
-from OpenGL import GLUT
+import keys
+from backend import GLUT
+from events import EventBus
 from trackball import Trackball
 
 
 class Interaction(object):
 
     """Handles user interaction"""
-    def __init__(self):
+    def __init__(self, headless=False):
         # currently pressed mouse button
         self.pressed = None
         # the current location of camera
@@ -15,10 +16,19 @@ class Interaction(object):
         self.trackball = Trackball(theta = -25, distance=15)
         # current mouse location
         self.mouse_loc = None
-        # Unsophisticated callback mechanism
-        self.callback = defaultdict(list)
+        # without a window events are fed in directly, e.g. by a replay
+        self.headless = headless
+        # callbacks, and a worker pool for queries too slow for GLUT's thread
+        self.bus = EventBus(workers=0 if headless else 2)
+        # window size to use when headless
+        self.window_size = (640, 480)
+        # number of redraws requested so far
+        self.redisplays = 0
+        # called instead of glutPostRedisplay when redraws are scheduled
+        self.on_redisplay = None
 
-        self.register()
+        if not headless:
+            self.register()
         print("interaction")
 
     def register(self):
@@ -29,14 +39,26 @@ class Interaction(object):
         GLUT.glutSpecialFunc(self.handle_keystroke)
 
     def register_callback(self, name,function):
-        self.callback[name].append(function)
+        self.bus.subscribe(name, function)
         print("register callback")
 
     def trigger(self, name, *args, **kwargs):
-        for func in self.callback[name]:
-            func(*args, **kwargs)
+        self.bus.publish(name, *args, **kwargs)
         print("trigger")
 
+    def get_window_size(self):
+        if self.headless:
+            return self.window_size
+        return GLUT.glutGet(GLUT.GLUT_WINDOW_WIDTH), GLUT.glutGet(GLUT.GLUT_WINDOW_HEIGHT)
+
+    def redisplay(self):
+        """Ask for the scene to be drawn again"""
+        self.redisplays += 1
+        if self.on_redisplay is not None:
+            self.on_redisplay()
+        elif not self.headless:
+            GLUT.glutPostRedisplay()
+
     def translate(self, x, y, z):
         """Translate the camera"""
         self.translation[0] += x
@@ -45,60 +67,68 @@ class Interaction(object):
 
     def handle_mouse_button(self,button, mode, x, y):
         """Called when mouse button is pressed or released"""
-        xSize, ySize = GLUT.glutGet(GLUT.GLUT_WINDOW_WIDTH), GLUT.glutGet(GLUT.GLUT_WINDOW_HEIGHT)
+        xSize, ySize = self.get_window_size()
         y = ySize - y # invert the y cordinate because opengl is inverted
         self.mouse_loc = (x, y)
 
-        if mode == GLUT.GLUT_DOWN:
+        if mode == keys.DOWN:
             self.pressed = button
-            if button == GLUT.GLUT_RIGHT_BUTTON:
+            if button == keys.RIGHT_BUTTON:
                 pass
-            elif button == GLUT.GLUT_LEFT_BUTTON: # pick
+            elif button == keys.LEFT_BUTTON: # pick
                 self.trigger('pick', x, y)
-            elif button == 3: # scroll up
+            elif button == keys.WHEEL_UP:
                 self.translate(0, 0, 0.1)
-            elif button == 4: # scroll down
+            elif button == keys.WHEEL_DOWN:
                 self.translate(0, 0, -0.1)
         else : # mouse button released
+            if self.pressed == keys.LEFT_BUTTON:
+                self.trigger('drop', x, y)
             self.pressed = None
-            GLUT.glutPostRedisplay()
+            self.redisplay()
 
         print("Handle mouse func")
 
     def handle_mouse_move(self, x, screen_y):
         """Called when mouse is moved"""
-        xSize, ySize = GLUT.glutGet(GLUT.GLUT_WINDOW_WIDTH), GLUT.glutGet(GLUT.GLUT_WINDOW_HEIGHT)
+        xSize, ySize = self.get_window_size()
         y = ySize - screen_y
         if self.pressed is not None:
             dx = x - self.mouse_loc[0]
             dy = y - self.mouse_loc[1]
-            if self.pressed == GLUT.GLUT_RIGHT_BUTTON and self.trackball is not None:
+            if self.pressed == keys.RIGHT_BUTTON and self.trackball is not None:
                 # ignore th updated camera loc because we 
                 # want to always rotate around origin
-                self.trackball.drag_to(self.mouse_loc[0], self.mouse_loc[1], dx, dy) 
-            elif self.pressed == GLUT.GLUT_LEFT_BUTTON:
+                self.trackball.drag_to(self.mouse_loc[0], self.mouse_loc[1], dx, dy,
+                                       (0, 0, xSize, ySize))
+            elif self.pressed == keys.LEFT_BUTTON:
                 self.trigger('move', x, y)
-            elif self.pressed == GLUT.GLUT_MIDDLE_BUTTON:
+            elif self.pressed == keys.MIDDLE_BUTTON:
                 self.translate(dx/60.0, dy/60.0, 0)
             else:
                 pass
-            GLUT.glutPostRedisplay()
+            self.redisplay()
         self.mouse_loc = (x, y)
 
         print("hansle mouse move")
 
     def handle_keystroke(self,key, x, screen_y):
         """Called on keyboard input from user"""
-        xSize, ySize = GLUT.glutGet(GLUT.GLUT_WINDOW_WIDTH), GLUT.glutGet(GLUT.GLUT_WINDOW_HEIGHT)
+        xSize, ySize = self.get_window_size()
         y = ySize - screen_y
         match key:
             case 's': self.trigger('place', 'sphere', x, y)
             case 'c': self.trigger('place', 'cube', x, y)
-            case GLUT.GLUT_KEY_UP: self.trigger('scale', up=True)
-            case GLUT.GLUT_KEY_DOWN: self.trigger('scale', up=False)
-            case GLUT.GLUT_KEY_LEFT: self.trigger('rotate_color', forward=True)
-            case GLUT.GLUT_KEY_RIGHT: self.trigger('rotate_color', forward=False)
+            case keys.KEY_UP: self.trigger('scale', up=True)
+            case keys.KEY_DOWN: self.trigger('scale', up=False)
+            case keys.KEY_LEFT: self.trigger('rotate_color', forward=True)
+            case keys.KEY_RIGHT: self.trigger('rotate_color', forward=False)
+            case 'f' | b'f': self.trigger('toggle_stats')
+            case 'd' | b'd': self.trigger('duplicate')
+            case 'p' | b'p': self.trigger('scatter')
+            case 'x' | b'x': self.trigger('remove')
+            case 'm' | b'm': self.trigger('memory_report')
             case _: print("had an stroke")
-        GLUT.glutPostRedisplay()
+        self.redisplay()
 
         print("Handle key stroke")
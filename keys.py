@@ -0,0 +1,24 @@
+"""
+Values GLUT passes to the mouse and special key callbacks.
+
+They are fixed by the GLUT API, so they are kept here as plain integers:
+handling replayed or scripted input must not import PyOpenGL.
+"""
+
+# mouse buttons
+LEFT_BUTTON = 0
+MIDDLE_BUTTON = 1
+RIGHT_BUTTON = 2
+# freeglut reports the wheel as buttons
+WHEEL_UP = 3
+WHEEL_DOWN = 4
+
+# button states
+DOWN = 0
+UP = 1
+
+# special keys
+KEY_LEFT = 100
+KEY_UP = 101
+KEY_RIGHT = 102
+KEY_DOWN = 103
@@ -1,5 +1,44 @@
+import argparse
+
+import startup
+from node import MeshNode
+from paging import ChunkStore
+from recording import Recorder
 from viewer import Viewer
 
 if __name__ == "__main__":
-    viewer = Viewer()
+    parser = argparse.ArgumentParser(description="3D Modeller")
+    parser.add_argument('--connect', metavar='HOST:PORT',
+                        help="share the scene through a sync server")
+    parser.add_argument('--record', metavar='FILE',
+                        help="record the input of this session for replay")
+    parser.add_argument('--mesh', metavar='FILE', action='append', default=[],
+                        help="import an .obj or binary .stl file into the scene")
+    parser.add_argument('--store', metavar='DIR',
+                        help="page in the nodes of a chunked scene store, see paging.py")
+    parser.add_argument('--autosave', metavar='DIR',
+                        help="open the scene saved in DIR and save changes to it as you edit")
+    parser.add_argument('--scatter', metavar='COUNT', type=int,
+                        help="add COUNT random spheres and cubes, to try large scenes")
+    parser.add_argument('--exit-after-first-frame', action='store_true',
+                        help="quit once drawn, used by startup.py to time cold starts")
+    args = parser.parse_args()
+
+    viewer = Viewer(sample_scene=not args.autosave)
+    if args.autosave:
+        viewer.start_autosave(args.autosave)
+    if args.store:
+        viewer.attach_store(ChunkStore(args.store))
+    for path in args.mesh:
+        viewer.scene.add_node(MeshNode(path))
+    if args.scatter:
+        viewer.scatter(args.scatter)
+    if args.exit_after_first_frame:
+        viewer.first_frame_callback = startup.first_frame_reached
+    if args.record:
+        recorder = Recorder(viewer.interaction, args.record)
+        recorder.register()
+    if args.connect:
+        host, port = args.connect.rsplit(':', 1)
+        viewer.connect(host, int(port))
     viewer.main_loop()
\ No newline at end of file
@@ -0,0 +1,280 @@
+"""
+Memory accounting by subsystem.
+
+A MemoryMonitor sizes what a Scene, and the Viewer around it, hold in four
+groups: the scene graph (node objects, their AABBs and matrices), spatial
+data (the spatial hash, query snapshot, occlusion buffers, paging store),
+render resources (the render queue, meshes and display lists, the trackball
+buffer) and history (copy-on-write snapshots, change tracking, frame
+statistics, sync queues). Arrays are counted once however many nodes share
+them, so the figures reflect the sharing done by scatter.build_nodes.
+
+Large collections are sized from an even sample and extrapolated, which
+keeps measuring a million node scene to a fraction of a second; such
+figures are marked as estimates. Peaks are kept across reports, and nodes removed
+from the scene are watched so any still alive later show up as leaks.
+
+    monitor = MemoryMonitor(scene, viewer)
+    monitor.measure()['scene graph']['bytes']
+    print('\\n'.join(monitor.lines()))
+"""
+import ctypes
+import gc
+import sys
+import weakref
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+from primitive import G_OBJ_CUBE, G_OBJ_PLANE, G_OBJ_SPHERE
+
+SUBSYSTEMS = ('scene graph', 'spatial', 'render', 'history')
+# members of a collection sized one by one before extrapolating
+SAMPLE = 2000
+# bytes each subsystem may use, subsystems left out have no budget
+BUDGETS = dict()
+PRIMITIVE_LISTS = (G_OBJ_PLANE, G_OBJ_SPHERE, G_OBJ_CUBE)
+# referrers reported for each leaked node
+MAX_REFERRERS = 4
+
+
+class Tally(object):
+    """ Bytes and object count of one subsystem, and whether they are estimated """
+
+    def __init__(self):
+        self.bytes = 0
+        self.objects = 0
+        self.estimated = False
+        # ids of the objects already counted, shared ones count once
+        self.seen = set()
+        # bytes of the buffers counted through views of them
+        self.shared = 0
+
+    def add(self, obj):
+        """ Count obj itself, and the buffers it is a view of """
+        base = False
+        while obj is not None and id(obj) not in self.seen:
+            self.seen.add(id(obj))
+            size = sys.getsizeof(obj)
+            if isinstance(obj, ctypes.Array):
+                size += ctypes.sizeof(obj)
+            self.bytes += size
+            self.objects += 1
+            if base:
+                self.shared += size
+            obj = getattr(obj, 'base', None)
+            base = True
+
+    def add_all(self, objects):
+        for obj in objects:
+            self.add(obj)
+
+    def add_sampled(self, items, size):
+        """
+        Count every item with size(tally, item), or an even sample of them
+        scaled up to the whole collection when there are many
+        """
+        count = len(items)
+        if count <= SAMPLE:
+            for item in items:
+                size(self, item)
+            return
+        stride = count // SAMPLE
+        before_bytes, before_objects, before_shared = self.bytes, self.objects, self.shared
+        for item in items[::stride][:SAMPLE]:
+            size(self, item)
+        # a buffer the sample reaches through views is the one all items share
+        shared = self.shared - before_shared
+        factor = count / float(SAMPLE)
+        self.bytes = before_bytes + shared + int((self.bytes - before_bytes - shared) * factor)
+        self.objects = before_objects + int((self.objects - before_objects) * factor)
+        self.estimated = True
+
+    def result(self):
+        return dict(bytes=self.bytes, objects=self.objects, estimated=self.estimated)
+
+
+def node_size(tally, node):
+    """ A node with its bounds, matrices and, for assemblies, children """
+    tally.add(node)
+    tally.add(node.__dict__)
+    aabb = node.__dict__.get('aabb') or node.__dict__.get('bounds_cache')
+    if aabb is not None:
+        tally.add_all((aabb, aabb.__dict__, aabb.center, aabb.size))
+    tally.add_all((node.translation_matrix, node.scaling_matrix))
+    for child in getattr(node, 'child_nodes', ()):
+        node_size(tally, child)
+    if hasattr(node, 'child_nodes'):
+        tally.add(node.child_nodes)
+
+
+class MemoryMonitor(object):
+    """ Reports the memory of a scene and viewer by subsystem """
+
+    def __init__(self, scene, viewer=None, budgets=None):
+        self.scene = scene
+        self.viewer = viewer
+        self.budgets = dict(BUDGETS if budgets is None else budgets)
+        self.peaks = {name: 0 for name in SUBSYSTEMS + ('total',)}
+        self.last = None
+        # node_id -> weak reference of the nodes taken out of the scene
+        self.removed = dict()
+        scene.add_listener(self.on_scene_event)
+
+    def on_scene_event(self, event, node):
+        if event == 'remove':
+            self.removed[node.node_id] = weakref.ref(node)
+
+    def measure(self):
+        """
+        Return {subsystem: dict(bytes, objects, estimated)}, plus 'total'
+        and 'process' with the peak resident size of the process if known
+        """
+        report = dict()
+        for name, measure in (('scene graph', self.scene_graph), ('spatial', self.spatial),
+                              ('render', self.render), ('history', self.history)):
+            tally = Tally()
+            measure(tally)
+            report[name] = tally.result()
+            self.peaks[name] = max(self.peaks[name], tally.bytes)
+        report['total'] = dict(bytes=sum(report[name]['bytes'] for name in SUBSYSTEMS),
+                               objects=sum(report[name]['objects'] for name in SUBSYSTEMS),
+                               estimated=any(report[name]['estimated'] for name in SUBSYSTEMS))
+        self.peaks['total'] = max(self.peaks['total'], report['total']['bytes'])
+        report['process'] = dict(peak_rss=peak_rss())
+        self.last = report
+        return report
+
+    def scene_graph(self, tally):
+        scene = self.scene
+        tally.add_all((scene.node_list, scene.node_index))
+        tally.add_sampled(scene.node_list, node_size)
+        if scene.store is not None:
+            tally.add_sampled(scene.store.resident_nodes(), node_size)
+
+    def spatial(self, tally):
+        scene = self.scene
+        spatial = scene.spatial
+        if spatial is not None:
+            tally.add_all((spatial, spatial.cells, spatial.node_keys, spatial.large))
+            tally.add_sampled(list(spatial.cells.values()), Tally.add)
+            tally.add_sampled(list(spatial.node_keys.values()),
+                              lambda tally, keys: tally.add_all((keys,) + keys))
+        snapshot = scene.snapshot_cache
+        if snapshot is not None:
+            tally.add_all((snapshot, snapshot.nodes, snapshot.translations,
+                           snapshot.inverse_scalings, snapshot.centers, snapshot.sizes))
+        culler = scene.culler
+        if culler is not None:
+            tally.add_all([getattr(culler, 'depth', None)] + culler.pyramid)
+        store = scene.store
+        if store is not None:
+            tally.add_all((store.counts, store.resident, store.node_chunk, store.dirty))
+            tally.add_all(store.resident.values())
+
+    def render(self, tally):
+        queue = self.scene.render_queue
+        tally.add_all((queue.keys, queue.matrices, queue.order, queue.transforms))
+        tally.add_sampled(queue.matrices, Tally.add)
+        # display lists live in the driver: the shared primitive lists, and
+        # one per drawn mesh holding about as much as its arrays
+        lists = len(PRIMITIVE_LISTS)
+        for node in self.scene.node_list:
+            if node.shape != 'mesh':
+                continue
+            mesh = node.mesh
+            tally.add_all((mesh, mesh.vertices, mesh.normals, mesh.indices))
+            if node.call_list is not None:
+                lists += 1
+                tally.bytes += mesh.vertices.nbytes + mesh.normals.nbytes + mesh.indices.nbytes
+        tally.objects += lists
+        interaction = getattr(self.viewer, 'interaction', None)
+        trackball = getattr(interaction, 'trackball', None)
+        if trackball is not None:
+            tally.add(getattr(trackball, '_matrix', None))
+
+    def history(self, tally):
+        scene = self.scene
+        tally.add_all((scene.modified, scene.removed, scene.snapshots))
+        with scene.snapshot_lock:
+            snapshots = list(scene.snapshots)
+        for snapshot in snapshots:
+            tally.add_all((snapshot.saved, snapshot.modified, snapshot.removed))
+            # the node list a snapshot holds on to once the scene copied its own
+            if snapshot.nodes is not scene.node_list:
+                tally.add(snapshot.nodes)
+            for color_index, translation_matrix, scaling_matrix in list(snapshot.saved.values()):
+                tally.add_all((translation_matrix, scaling_matrix))
+        scheduler = getattr(self.viewer, 'scheduler', None)
+        if scheduler is not None:
+            tally.add_all((scheduler.stats.times, scheduler.stats.missed))
+        sync = getattr(self.viewer, 'sync', None)
+        if sync is not None:
+            tally.add(sync.outgoing)
+            tally.add_all(list(sync.outgoing.values()))
+
+    def leaks(self):
+        """
+        Return (node_id, shape, referrer types) of the removed nodes still
+        alive after a collection. Live snapshots keep removed nodes until
+        they are released, so leaks are only certain once none are pending.
+        """
+        if not any(reference() is not None for reference in self.removed.values()):
+            self.removed.clear()
+            return []
+        # nodes of assemblies are in reference cycles with their children
+        gc.collect()
+        leaked = []
+        for node_id, reference in list(self.removed.items()):
+            node = reference()
+            if node is None:
+                del self.removed[node_id]
+                continue
+            referrers = [type(referrer).__name__ for referrer in gc.get_referrers(node)
+                         if referrer is not self.removed and not isinstance(referrer, weakref.ref)]
+            leaked.append((node_id, node.shape, referrers[:MAX_REFERRERS]))
+        return leaked
+
+    def over_budget(self):
+        """ Subsystems whose last measured bytes exceed their budget """
+        report = self.last or self.measure()
+        return [name for name, budget in self.budgets.items()
+                if name in report and report[name]['bytes'] > budget]
+
+    def lines(self):
+        """ A fresh report as text, for the hotkey dump """
+        report = self.measure()
+        lines = ["memory          bytes      objects      peak"]
+        for name in SUBSYSTEMS + ('total',):
+            entry = report[name]
+            peak = self.peaks[name]
+            mark = '~' if entry['estimated'] else ' '
+            budget = self.budgets.get(name)
+            over = f"  over budget {format_bytes(budget)}" if budget and entry['bytes'] > budget else ''
+            lines.append(f"{name:12} {mark}{format_bytes(entry['bytes']):>10} {entry['objects']:12d} "
+                         f"{format_bytes(peak):>9}{over}")
+        if report['process']['peak_rss'] is not None:
+            lines.append(f"process peak rss {format_bytes(report['process']['peak_rss'])}")
+        for node_id, shape, referrers in self.leaks():
+            lines.append(f"leak: removed {shape} {node_id} still referenced by "
+                         f"{', '.join(referrers) or 'nothing known'}")
+        return lines
+
+
+def peak_rss():
+    """ Largest resident set size of the process so far in bytes, None if unknown """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def format_bytes(count):
+    for unit in ('B', 'KB', 'MB'):
+        if abs(count) < 1024:
+            return f"{count:.0f} {unit}" if unit == 'B' else f"{count:.1f} {unit}"
+        count /= 1024.0
+    return f"{count:.1f} GB"
@@ -0,0 +1,286 @@
+"""
+Streaming import of OBJ and binary STL meshes.
+
+Files are parsed a block at a time with NumPy, never as one Python object per
+vertex or face. Identical vertices are merged, smooth normals are computed
+with vectorized code, and the result is stored next to the source file in a
+binary cache so loading the same file again only reads three arrays back.
+"""
+import os
+import struct
+
+import numpy
+
+# bytes of OBJ text parsed at once
+CHUNK_SIZE = 1 << 22
+
+CACHE_SUFFIX = '.meshcache'
+CACHE_MAGIC = b'MESH'
+CACHE_VERSION = 1
+# magic, version, source size, source mtime, vertex count, index count
+CACHE_HEADER = struct.Struct('<4sHqqQQ')
+
+STL_HEADER_SIZE = 84
+STL_RECORD = numpy.dtype([
+    ('normal', '<f4', (3,)),
+    ('vertices', '<f4', (3, 3)),
+    ('attribute', '<u2'),
+])
+
+SPACE, TAB, NEWLINE, RETURN, SLASH, HASH = 32, 9, 10, 13, 47, 35
+
+# odd multipliers mixing the three coordinates into one vertex hash
+HASH_X = numpy.uint64(0x9E3779B97F4A7C15)
+HASH_Y = numpy.uint64(0xC2B2AE3D27D4EB4F)
+HASH_Z = numpy.uint64(0x165667B19E3779F9)
+
+
+class Mesh(object):
+    """ An indexed triangle mesh """
+
+    def __init__(self, vertices, normals, indices):
+        # float32 arrays of shape (n, 3)
+        self.vertices = vertices
+        self.normals = normals
+        # uint32 array, three entries per triangle
+        self.indices = indices
+
+    def bounds(self):
+        """ Return the (min, max) corners of the tight bounding box """
+        if not len(self.vertices):
+            return numpy.zeros(3), numpy.zeros(3)
+        return self.vertices.min(axis=0), self.vertices.max(axis=0)
+
+    def nbytes(self):
+        return self.vertices.nbytes + self.normals.nbytes + self.indices.nbytes
+
+
+def load(path, use_cache=True):
+    """ Load an .obj or binary .stl file, from its cache when it is current """
+    stat = os.stat(path)
+    cache_path = path + CACHE_SUFFIX
+    if use_cache:
+        mesh = read_cache(cache_path, stat)
+        if mesh is not None:
+            return mesh
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.stl':
+        positions, triangles = read_stl(path), None
+    elif extension == '.obj':
+        positions, triangles = read_obj(path)
+    else:
+        raise ValueError(f"can't import {path}: only .obj and .stl are supported")
+
+    vertices, indices = deduplicate(positions, triangles)
+    mesh = Mesh(vertices, compute_normals(vertices, indices), indices)
+    if use_cache:
+        write_cache(cache_path, stat, mesh)
+    return mesh
+
+
+def read_stl(path):
+    """ Return the corner positions of every triangle of a binary STL file """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        header = f.read(STL_HEADER_SIZE)
+        if len(header) < STL_HEADER_SIZE:
+            raise ValueError(f"{path} is too short to be an STL file")
+        count = struct.unpack_from('<I', header, 80)[0]
+        if size != STL_HEADER_SIZE + count * STL_RECORD.itemsize:
+            raise ValueError(f"{path} is not a binary STL file")
+        records = numpy.fromfile(f, dtype=STL_RECORD, count=count)
+    return records['vertices'].reshape(-1, 3)
+
+
+def read_obj(path):
+    """ Return (positions, triangles) of an OBJ file, polygons are fanned """
+    vertex_blocks = []
+    triangle_blocks = []
+    vertex_count = 0
+    remainder = b''
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                block, remainder = remainder, b''
+                if block and not block.endswith(b'\n'):
+                    block += b'\n'
+            else:
+                # only hand complete lines to the parser
+                data = remainder + data
+                cut = data.rfind(b'\n') + 1
+                block, remainder = data[:cut], data[cut:]
+            if block:
+                vertices, triangles = parse_obj_block(block, vertex_count)
+                vertex_blocks.append(vertices)
+                triangle_blocks.append(triangles)
+                vertex_count += len(vertices)
+            if not data:
+                break
+
+    if not vertex_blocks:
+        return numpy.zeros((0, 3), numpy.float32), numpy.zeros((0, 3), numpy.int64)
+    return numpy.concatenate(vertex_blocks), numpy.concatenate(triangle_blocks)
+
+
+def token_starts(text):
+    """ Whether each byte of text begins a whitespace separated token """
+    whitespace = (text == SPACE) | (text == TAB) | (text == NEWLINE) | (text == RETURN)
+    return ~whitespace & numpy.concatenate(([True], whitespace[:-1]))
+
+
+def parse_obj_block(block, vertex_base):
+    """
+    Parse the 'v' and 'f' lines of a block of complete OBJ lines.
+
+    vertex_base is the number of vertices in the blocks before this one, it
+    resolves the negative (relative) indices OBJ allows.
+    """
+    text = numpy.frombuffer(block, numpy.uint8).copy()
+    newlines = numpy.flatnonzero(text == NEWLINE)
+    starts = numpy.concatenate(([0], newlines[:-1] + 1))
+    line_of_byte = numpy.cumsum(text == NEWLINE) - (text == NEWLINE)
+    # blank comments, from the first '#' of a line to its end
+    hashes = numpy.flatnonzero(text == HASH)
+    if len(hashes):
+        lines, first = numpy.unique(line_of_byte[hashes], return_index=True)
+        begin = hashes[first]
+        lengths = newlines[lines] - begin
+        skip = numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+        text[numpy.repeat(begin, lengths) + numpy.arange(int(lengths.sum())) - skip] = SPACE
+    first = text[starts]
+    second = text[numpy.minimum(starts + 1, len(text) - 1)]
+    separated = (second == SPACE) | (second == TAB)
+    is_vertex = (first == ord('v')) & separated
+    is_face = (first == ord('f')) & separated
+    # blank the keywords so only numbers are left on the lines
+    text[starts[is_vertex | is_face]] = SPACE
+
+    vertex_count = int(is_vertex.sum())
+    numbers = text[is_vertex[line_of_byte]]
+    values = numpy.fromstring(numbers.tobytes(), dtype=numpy.float32, sep=' ')
+    # parsing stops at the first token that is not a number
+    if len(values) != int(token_starts(numbers).sum()):
+        raise ValueError("OBJ vertex lines hold a value that is not a number")
+    if vertex_count and len(values) % vertex_count:
+        raise ValueError("OBJ vertex lines have differing numbers of components")
+    width = len(values) // vertex_count if vertex_count else 3
+    vertices = values.reshape(vertex_count, width)[:, :3]
+
+    faces = text[is_face[line_of_byte]]
+    face_count = int(is_face.sum())
+    if not face_count:
+        return vertices, numpy.zeros((0, 3), numpy.int64)
+
+    # drop the texture and normal references of 'v/vt/vn' corners
+    whitespace = (faces == SPACE) | (faces == TAB) | (faces == NEWLINE) | (faces == RETURN)
+    slashes = numpy.cumsum(faces == SLASH)
+    since_whitespace = slashes - numpy.maximum.accumulate(numpy.where(whitespace, slashes, 0))
+    faces[(since_whitespace > 0) & ~whitespace] = SPACE
+
+    face_of_byte = numpy.cumsum(faces == NEWLINE) - (faces == NEWLINE)
+    corners = numpy.bincount(face_of_byte[token_starts(faces)], minlength=face_count)
+    indices = numpy.fromstring(faces.tobytes(), dtype=numpy.int64, sep=' ')
+    if len(indices) != int(corners.sum()):
+        raise ValueError("OBJ face lines hold an index that is not a number")
+
+    # OBJ counts from 1, negative indices count back from the last vertex
+    seen = vertex_base + numpy.cumsum(is_vertex) - is_vertex
+    seen = numpy.repeat(seen[is_face], corners)
+    indices = numpy.where(indices < 0, seen + indices, indices - 1)
+
+    # fan every polygon into triangles (0, j, j+1)
+    fans = numpy.maximum(corners - 2, 0)
+    face_start = numpy.cumsum(corners) - corners
+    triangle_face = numpy.repeat(numpy.arange(face_count), fans)
+    j = numpy.arange(int(fans.sum())) - numpy.repeat(numpy.cumsum(fans) - fans, fans) + 1
+    base = face_start[triangle_face]
+    triangles = numpy.stack((indices[base], indices[base + j], indices[base + j + 1]), axis=1)
+    return vertices, triangles
+
+
+def deduplicate(positions, triangles=None):
+    """
+    Merge vertices with identical coordinates.
+
+    Vertices are grouped by a 64 bit hash of their raw bytes; if two different
+    vertices ever share a hash they are grouped by the bytes themselves.
+    Returns the unique vertices and the uint32 index of every triangle corner.
+    """
+    # adding zero turns -0.0 into 0.0 so both get the same key
+    positions = numpy.ascontiguousarray(positions, dtype=numpy.float32) + numpy.float32(0)
+    if not len(positions):
+        return positions, numpy.zeros(0, numpy.uint32)
+    bits = positions.view(numpy.uint32).astype(numpy.uint64)
+    keys = bits[:, 0] * HASH_X ^ bits[:, 1] * HASH_Y ^ bits[:, 2] * HASH_Z
+    first, inverse = group(keys)
+    vertices = positions[first]
+    if not (vertices[inverse] == positions).all():
+        keys = positions.view(numpy.dtype((numpy.void, 12))).ravel()
+        first, inverse = group(keys)
+        vertices = positions[first]
+    if triangles is None:
+        return vertices, inverse
+    return vertices, inverse[numpy.asarray(triangles).ravel()]
+
+
+def group(keys):
+    """ Return the first position of every distinct key and each key's group """
+    order = numpy.argsort(keys)
+    sorted_keys = keys[order]
+    new = numpy.empty(len(keys), bool)
+    new[0] = True
+    numpy.not_equal(sorted_keys[1:], sorted_keys[:-1], out=new[1:])
+    inverse = numpy.empty(len(keys), numpy.uint32)
+    inverse[order] = numpy.cumsum(new) - 1
+    return order[new], inverse
+
+
+def compute_normals(vertices, indices):
+    """ Area weighted vertex normals """
+    corners = vertices[indices.reshape(-1, 3)]
+    face = numpy.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    normals = numpy.empty_like(vertices)
+    for axis in range(3):
+        normals[:, axis] = numpy.bincount(indices, weights=numpy.repeat(face[:, axis], 3),
+                                          minlength=len(vertices))
+    length = numpy.linalg.norm(normals, axis=1, keepdims=True)
+    normals /= numpy.where(length == 0, 1, length)
+    return normals
+
+
+def read_cache(cache_path, stat):
+    """ Return the cached mesh, or None when missing or out of date """
+    try:
+        f = open(cache_path, 'rb')
+    except OSError:
+        return None
+    with f:
+        header = f.read(CACHE_HEADER.size)
+        if len(header) != CACHE_HEADER.size:
+            return None
+        magic, version, size, mtime, vertex_count, index_count = CACHE_HEADER.unpack(header)
+        if (magic, version, size, mtime) != (CACHE_MAGIC, CACHE_VERSION, stat.st_size, stat.st_mtime_ns):
+            return None
+        vertices = numpy.fromfile(f, numpy.float32, vertex_count * 3).reshape(-1, 3)
+        normals = numpy.fromfile(f, numpy.float32, vertex_count * 3).reshape(-1, 3)
+        indices = numpy.fromfile(f, numpy.uint32, index_count)
+    if len(indices) != index_count:
+        return None
+    return Mesh(vertices, normals, indices)
+
+
+def write_cache(cache_path, stat, mesh):
+    """ Store mesh next to its source, a failed write only costs the cache """
+    temp_path = cache_path + '.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, stat.st_size,
+                                      stat.st_mtime_ns, len(mesh.vertices), len(mesh.indices)))
+            mesh.vertices.tofile(f)
+            mesh.normals.tofile(f)
+            mesh.indices.tofile(f)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        pass
@@ -1,21 +1,29 @@
-from OpenGL import GL
+from backend import GL
 import numpy
 
 import random
 
 import color
+import mesh
 from aabb import AABB
 from primitive import G_OBJ_SPHERE, G_OBJ_CUBE
 from transformation import scaling, translation
 
 class Node(object):
     """Base class for nodes in scene"""
+    # name used by Scene.place and the sync protocol, None for abstract nodes
+    shape = None
+
     def __init__(self):
         self.color_index = random.randint(color.MIN_COLOR, color.MAX_COLOR)
         self.aabb = AABB([0.0, 0.0, 0.0], [0.5, 0.5, 0.5])
         self.translation_matrix = numpy.identity(4)
         self.scaling_matrix = numpy.identity(4)
         self.selected = False
+        # identifier shared with other editors, assigned by the scene
+        self.node_id = None
+        # the HierarchicalNode this node is a child of
+        self.parent = None
 
     def render(self):
         """renders the item to the screen"""
@@ -39,6 +47,17 @@ class Node(object):
             "The abstract Node Class doesn't define 'render_self'"
         )
 
+    def submit(self, queue, parent_matrix, selected=False):
+        """queues the item for drawing instead of rendering it directly"""
+        matrix = numpy.dot(numpy.dot(parent_matrix, self.translation_matrix),
+                           self.scaling_matrix)
+        self.submit_self(queue, matrix, selected or self.selected)
+
+    def submit_self(self, queue, matrix, selected):
+        raise NotImplementedError(
+            "The abstract Node Class doesn't define 'submit_self'"
+        )
+
     def pick(self, start, direction, mat):
         """ 
         Return whether or not the ray hits the object
@@ -55,6 +74,28 @@ class Node(object):
         )
         result = self.aabb.ray_hit(start, direction, newmat)
         return result
+
+    def pick_path(self, start, direction, mat):
+        """
+        Return (path, distance) of the closest node hit by the ray, path
+        leading from this node down to it, or (None, None) on a miss
+        """
+        hit, distance = self.pick(start, direction, mat)
+        if not hit:
+            return None, None
+        return self.drill_down(start, direction, mat, distance)
+
+    def drill_down(self, start, direction, mat, distance):
+        """ Refine a hit on this node's bounds, see pick_path """
+        return [self], distance
+
+    def bounds_changed(self):
+        """ Drop the cached bounds of the ancestors, they no longer fit """
+        parent = self.parent
+        # an ancestor is only cached while all its descendants are
+        while parent is not None and parent.bounds_cache is not None:
+            parent.bounds_cache = None
+            parent = parent.parent
     
     def select(self, select=None):
         """ Toggles or sets selected state """
@@ -72,13 +113,21 @@ class Node(object):
 
     def scale(self, up):
         s =  1.1 if up else 0.9
-        self.scaling_matrix = numpy.dot(self.scaling_matrix, scaling([s, s, s]))
         self.aabb.scale(s)
+        self.scaling_matrix = numpy.dot(self.scaling_matrix, scaling([s, s, s]))
+        self.bounds_changed()
+
+    def scale_to(self, s):
+        """ Set an absolute uniform scale """
+        self.aabb.scale(s / self.scaling_matrix[0, 0])
+        self.scaling_matrix = scaling([s, s, s])
+        self.bounds_changed()
 
     def translate(self, x, y, z):
         self.translation_matrix = numpy.dot(
             self.translation_matrix, 
             translation([x, y, z]))
+        self.bounds_changed()
 
 
 class Primitive(Node):
@@ -89,40 +138,129 @@ class Primitive(Node):
     def render_self(self):
         GL.glCallList(self.call_list)
 
+    def submit_self(self, queue, matrix, selected):
+        queue.submit(self.call_list, matrix, color.COLORS[self.color_index], selected)
+
 
 class Sphere(Primitive):
     """Sphere primitive"""
+    shape = 'sphere'
+
     def __init__(self):
         super(Sphere, self).__init__()
         self.call_list = G_OBJ_SPHERE
 
 class Cube(Primitive):
     """Cube primitive"""
+    shape = 'cube'
+
     def __init__(self):
         super(Cube, self).__init__()
         self.call_list = G_OBJ_CUBE
 
+class MeshNode(Primitive):
+    """Triangle mesh imported from an OBJ or binary STL file"""
+    shape = 'mesh'
+
+    def __init__(self, path):
+        super(MeshNode, self).__init__()
+        self.path = path
+        self.mesh = mesh.load(path)
+        low, high = self.mesh.bounds()
+        self.aabb = AABB((low + high) / 2.0, (high - low) / 2.0)
+
+    def render_self(self):
+        GL.glCallList(self.display_list())
+
+    def submit_self(self, queue, matrix, selected):
+        queue.submit(self.call_list, matrix, color.COLORS[self.color_index], selected, self)
+
+    def display_list(self):
+        """compiles the mesh the first time it is drawn"""
+        if self.call_list is None:
+            self.call_list = GL.glGenLists(1)
+            GL.glNewList(self.call_list, GL.GL_COMPILE)
+            GL.glEnableClientState(GL.GL_VERTEX_ARRAY)
+            GL.glEnableClientState(GL.GL_NORMAL_ARRAY)
+            GL.glVertexPointer(3, GL.GL_FLOAT, 0, self.mesh.vertices)
+            GL.glNormalPointer(GL.GL_FLOAT, 0, self.mesh.normals)
+            GL.glDrawElements(GL.GL_TRIANGLES, len(self.mesh.indices),
+                              GL.GL_UNSIGNED_INT, self.mesh.indices)
+            GL.glDisableClientState(GL.GL_NORMAL_ARRAY)
+            GL.glDisableClientState(GL.GL_VERTEX_ARRAY)
+            GL.glEndList()
+        return self.call_list
+
 class HierarchicalNode(Node):
     def __init__(self):
         super(HierarchicalNode, self).__init__()
         self.child_nodes = []
+        # bounds of the children, computed when first needed
+        self.bounds_cache = None
+
+    @property
+    def aabb(self):
+        """ The box around all children, in this node's scaled frame """
+        if self.bounds_cache is None:
+            self.bounds_cache = self.compute_bounds()
+        return self.bounds_cache
+
+    @aabb.setter
+    def aabb(self, aabb):
+        # kept until a child changes
+        self.bounds_cache = aabb
+
+    def compute_bounds(self):
+        if not self.child_nodes:
+            return AABB([0.0, 0.0, 0.0], [0.0, 0.0, 0.0])
+        centers = numpy.array([child.translation_matrix[:3, 3] + child.aabb.center
+                               for child in self.child_nodes])
+        sizes = numpy.array([child.aabb.size for child in self.child_nodes])
+        low = (centers - sizes).min(axis=0)
+        high = (centers + sizes).max(axis=0)
+        scale = numpy.diagonal(self.scaling_matrix)[:3]
+        return AABB((low + high) / 2.0 * scale, (high - low) / 2.0 * numpy.abs(scale))
+
+    def add_child(self, child):
+        child.parent = self
+        self.child_nodes.append(child)
+        self.bounds_cache = None
+        self.bounds_changed()
+
+    def drill_down(self, start, direction, mat, distance):
+        """ Find the closest child hit, skipping children whose bounds miss """
+        matrix = numpy.dot(numpy.dot(mat, self.translation_matrix), self.scaling_matrix)
+        closest, closest_distance = None, None
+        for child in self.child_nodes:
+            path, distance = child.pick_path(start, direction, matrix)
+            if path is not None and (closest is None or distance < closest_distance):
+                closest, closest_distance = path, distance
+        if closest is None:
+            return None, None
+        return [self] + closest, closest_distance
 
     def render_self(self):
         for child in self.child_nodes:
             child.render()
 
+    def submit_self(self, queue, matrix, selected):
+        queue.submit_group(self.selected)
+        # children draw in their own color, glowing with their parent
+        for child in self.child_nodes:
+            child.submit(queue, matrix, selected)
+
 class SnowFigure(HierarchicalNode):
+    shape = 'figure'
+
     def __init__(self):
         super(SnowFigure, self).__init__()
-        self.child_nodes = [Sphere(), Sphere(), Sphere()]
+        for _ in range(3):
+            self.add_child(Sphere())
         self.child_nodes[0].translate(0, -0.6, 0) # scale 1.0
         self.child_nodes[1].translate(0, 0.1, 0)
-        self.child_nodes[1].scaling_matrix = numpy.dot(
-            self.scaling_matrix, scaling([0.8, 0.8, 0.8]))
+        self.child_nodes[1].scale_to(0.8)
         self.child_nodes[2].translate(0, 0.75, 0)
-        self.child_nodes[2].scaling_matrix = numpy.dot(
-            self.scaling_matrix, scaling([0.7, 0.7, 0.7]))
+        self.child_nodes[2].scale_to(0.7)
         for child_node in self.child_nodes:
             child_node.color_index = color.MIN_COLOR
-        self.aabb = AABB([0.0, 0.0, 0.0], [0.5, 1.1, 0.5])
         print("Snow figure")
\ No newline at end of file
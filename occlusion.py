@@ -0,0 +1,195 @@
+"""
+Occlusion culling on the CPU.
+
+Each frame the few nodes covering most of the screen are drawn as occluders
+into a small depth buffer with NumPy. The buffer is reduced into a
+hierarchical-Z pyramid, each level keeping the farthest depth of four texels
+of the level below, so any node's screen rectangle is covered by at most
+2x2 texels of some level. A node whose nearest point lies behind the
+farthest occluder depth over its rectangle can't be seen and is not drawn.
+
+Occluders are drawn conservatively: only the box inside each occluder's
+solid shape, only pixels it covers completely, at the farthest depth of the
+covering face. Culling may keep hidden nodes but never drops visible ones.
+"""
+import math
+
+import numpy
+
+# depth buffer resolution, independent of the window
+WIDTH = 128
+HEIGHT = 72
+# the eye side clip distance, nodes reaching past it are never culled
+NEAR = 0.1
+MAX_OCCLUDERS = 8
+# scenes with fewer nodes are drawn without culling
+MIN_NODES = 32
+
+# half extent of the largest box inside each shape, relative to its AABB
+OCCLUDER_FILL = {
+    'cube': 1.0,
+    'sphere': 1.0 / math.sqrt(3.0),
+}
+
+# box corners: bit 0, 1, 2 of the index pick the high x, y, z
+CORNERS = numpy.array([[(i >> axis) & 1 for axis in range(3)] for i in range(8)])
+# box faces as corner indices, counter clockwise seen from outside
+FACES = numpy.array([
+    [1, 3, 7, 5], [0, 4, 6, 2],
+    [2, 6, 7, 3], [0, 1, 5, 4],
+    [4, 5, 7, 6], [0, 2, 3, 1],
+])
+
+
+class OcclusionCuller(object):
+
+    def __init__(self, width=WIDTH, height=HEIGHT):
+        self.width = width
+        self.height = height
+        self.pyramid = []
+        self.stats = dict(tested=0, occluders=0, occluded=0, outside=0)
+
+    def cull(self, snapshot, view, projection):
+        """ Return the nodes of a QuerySnapshot that may be visible, in order """
+        self.stats = dict(tested=0, occluders=0, occluded=0, outside=0)
+        nodes = snapshot.nodes
+        if len(nodes) < MIN_NODES:
+            return list(nodes)
+        centers = snapshot.translations[:, :3, 3] + snapshot.centers
+        sizes = snapshot.sizes
+        matrix = numpy.dot(projection, view)
+        screen, depth = self.project(centers, sizes, matrix)
+
+        self.clear()
+        for index in self.choose_occluders(nodes, centers, sizes, depth):
+            fill = OCCLUDER_FILL[nodes[index].shape]
+            corners, corner_depth = self.project(centers[index:index + 1],
+                                                 sizes[index:index + 1] * fill, matrix)
+            self.draw_box(corners[0], corner_depth[0])
+            self.stats['occluders'] += 1
+        self.build_pyramid()
+
+        outside, occluded = self.test(screen, depth)
+        self.stats.update(tested=len(nodes), outside=int(outside.sum()),
+                          occluded=int(occluded.sum()))
+        hidden = outside | occluded
+        return [node for node, skip in zip(nodes, hidden) if not skip]
+
+    def project(self, centers, sizes, matrix):
+        """ Return the pixel position (n, 8, 2) and depth (n, 8) of every box corner """
+        corners = numpy.ones((len(centers), 8, 4))
+        corners[:, :, :3] = (centers[:, None, :] - sizes[:, None, :]
+                             + 2.0 * sizes[:, None, :] * CORNERS)
+        clip = numpy.matmul(corners, matrix.T)
+        depth = clip[:, :, 3]
+        w = numpy.where(depth > NEAR, depth, 1.0)
+        screen = numpy.empty(clip.shape[:2] + (2,))
+        screen[:, :, 0] = (clip[:, :, 0] / w + 1.0) * self.width / 2.0
+        screen[:, :, 1] = (clip[:, :, 1] / w + 1.0) * self.height / 2.0
+        return screen, depth
+
+    def choose_occluders(self, nodes, centers, sizes, depth):
+        """ Indices of the solid nodes in front of the eye that look largest """
+        solid = numpy.array([node.shape in OCCLUDER_FILL for node in nodes])
+        candidates = numpy.flatnonzero(solid & (depth.min(axis=1) > NEAR))
+        if not len(candidates):
+            return candidates
+        # apparent size: extent over distance, squared
+        nearest = depth[candidates].min(axis=1)
+        score = (sizes[candidates].max(axis=1) / nearest) ** 2
+        if len(candidates) > MAX_OCCLUDERS:
+            best = numpy.argpartition(-score, MAX_OCCLUDERS)[:MAX_OCCLUDERS]
+            candidates = candidates[best]
+        return candidates
+
+    def clear(self):
+        self.depth = numpy.full((self.height, self.width), numpy.inf)
+
+    def draw_box(self, screen, depth):
+        """ Draw a box's front faces, and its outline to fill the seams between them """
+        faces = screen[FACES]
+        x, y = faces[:, :, 0], faces[:, :, 1]
+        # twice the signed area, positive for faces turned towards the eye
+        area = (x * numpy.roll(y, -1, axis=1) - numpy.roll(x, -1, axis=1) * y).sum(axis=1)
+        front = area > 0
+        if not front.any():
+            return
+        face_depth = depth[FACES].max(axis=1)
+        for points, farthest in zip(faces[front], face_depth[front]):
+            self.fill_convex(points, farthest)
+        self.fill_convex(convex_hull(screen), face_depth[front].max())
+
+    def fill_convex(self, points, depth):
+        """ Set depth on the pixels fully inside the counter clockwise polygon """
+        x0, y0 = numpy.maximum(numpy.floor(points.min(axis=0)), 0).astype(int)
+        x1, y1 = numpy.minimum(numpy.ceil(points.max(axis=0)),
+                               (self.width, self.height)).astype(int)
+        if x1 <= x0 or y1 <= y0:
+            return
+        # pixel corners, a pixel is covered when all four are inside every edge
+        xs = numpy.arange(x0, x1 + 1, dtype=float)
+        ys = numpy.arange(y0, y1 + 1, dtype=float)[:, None]
+        edges = numpy.roll(points, -1, axis=0) - points
+        inside = numpy.all(edges[:, 0, None, None] * (ys - points[:, 1, None, None])
+                           - edges[:, 1, None, None] * (xs - points[:, 0, None, None]) >= 0,
+                           axis=0)
+        covered = inside[:-1, :-1] & inside[1:, :-1] & inside[:-1, 1:] & inside[1:, 1:]
+        region = self.depth[y0:y1, x0:x1]
+        region[covered] = numpy.minimum(region[covered], depth)
+
+    def build_pyramid(self):
+        """ Halve the depth buffer until one texel is left, keeping the farthest depth """
+        level = self.depth
+        self.pyramid = [level]
+        while level.shape != (1, 1):
+            height, width = level.shape
+            # an odd row or column is paired with unknown, never occluding, depth
+            padded = numpy.full((height + height % 2, width + width % 2), numpy.inf)
+            padded[:height, :width] = level
+            level = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2).max(axis=(1, 3))
+            self.pyramid.append(level)
+
+    def test(self, screen, depth):
+        """ Return masks of the boxes outside the screen and behind the occluders """
+        count = len(depth)
+        low = numpy.floor(screen.min(axis=1)).astype(numpy.int64)
+        high = numpy.floor(screen.max(axis=1)).astype(numpy.int64)
+        nearest = depth.min(axis=1)
+        # boxes reaching behind the eye are never culled
+        crossing = nearest <= NEAR
+        size = numpy.array([self.width, self.height])
+        outside = ~crossing & numpy.any((high < 0) | (low >= size), axis=1)
+
+        low = numpy.clip(low, 0, size - 1)
+        high = numpy.clip(high, 0, size - 1)
+        span = (high - low + 1).max(axis=1)
+        levels = numpy.minimum(numpy.ceil(numpy.log2(span)).astype(numpy.int64),
+                               len(self.pyramid) - 1)
+        farthest = numpy.full(count, numpy.inf)
+        for level in numpy.unique(levels):
+            rows = numpy.flatnonzero(levels == level)
+            texels = self.pyramid[level]
+            x0, y0 = (low[rows] >> level).T
+            x1, y1 = (high[rows] >> level).T
+            farthest[rows] = numpy.maximum.reduce([
+                texels[y0, x0], texels[y0, x1], texels[y1, x0], texels[y1, x1]])
+
+        occluded = ~crossing & ~outside & (nearest > farthest)
+        return outside, occluded
+
+
+def convex_hull(points):
+    """ The counter clockwise convex hull of a few 2D points """
+    points = sorted(map(tuple, points))
+
+    def half(points):
+        hull = []
+        for p in points:
+            while len(hull) >= 2 and ((hull[-1][0] - hull[-2][0]) * (p[1] - hull[-2][1])
+                                      - (hull[-1][1] - hull[-2][1]) * (p[0] - hull[-2][0])) <= 0:
+                hull.pop()
+            hull.append(p)
+        return hull
+
+    lower, upper = half(points), half(reversed(points))
+    return numpy.array(lower[:-1] + upper[:-1])
@@ -0,0 +1,338 @@
+"""
+Out-of-core scene storage.
+
+A ChunkStore partitions nodes into a uniform grid of cubic chunks, one file
+per chunk on disk. Only the chunks near the camera and inside its view cone
+are kept in memory, within a budget; the least recently needed chunks are
+evicted first, after writing back any that were edited. Chunks ahead of the
+camera's motion are read from disk in the background before they are needed.
+
+Build a test site with:  python paging.py site_dir --generate 1000000
+"""
+import argparse
+import math
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+from scene import SHAPES, make_node
+
+RECORD = numpy.dtype([
+    ('node_id', '<u8'),
+    ('shape', 'u1'),
+    ('color', 'u1'),
+    ('location', '<f8', (3,)),
+    ('scale', '<f8'),
+])
+SHAPE_NAMES = sorted(SHAPES)
+SHAPE_CODES = {name: code for code, name in enumerate(SHAPE_NAMES)}
+
+# rough memory cost of one resident node: the object, its AABB and two 4x4 matrices
+NODE_BYTES = 1600
+# frames of camera motion to look ahead when prefetching
+PREFETCH_FRAMES = 30
+# chunks turned into nodes per update, so paging never stalls a frame for long
+LOADS_PER_UPDATE = 4
+# seconds between writing edited resident chunks back to disk
+FLUSH_INTERVAL = 30.0
+
+
+def node_record(node):
+    record = numpy.zeros((), RECORD)
+    record['node_id'] = node.node_id
+    record['shape'] = SHAPE_CODES[node.shape]
+    record['color'] = node.color_index
+    record['location'] = node.translation_matrix[:3, 3]
+    record['scale'] = node.scaling_matrix[0, 0]
+    return record
+
+
+class ChunkStore(object):
+
+    def __init__(self, directory, chunk_size=32.0, budget=256 * 1024 * 1024,
+                 view_distance=300.0, fov=100.0):
+        self.directory = directory
+        # edge length of a chunk in world units
+        self.chunk_size = chunk_size
+        # bytes of resident nodes allowed
+        self.budget = budget
+        self.view_distance = view_distance
+        # full angle of the view cone in degrees
+        self.fov = fov
+        os.makedirs(directory, exist_ok=True)
+
+        # node count of every chunk on disk
+        self.counts = dict()
+        # ids below this are taken by nodes in the store
+        self.next_node_id = 0
+        self.load_index()
+        # resident chunks, least recently needed first
+        self.resident = OrderedDict()
+        self.node_chunk = dict()
+        self.dirty = set()
+        # chunk key -> future of its records being read in the background
+        self.reading = dict()
+        self.reader = ThreadPoolExecutor(1, thread_name_prefix='chunk')
+        self.last_camera = None
+        self.stats = dict(loads=0, evictions=0, writes=0, prefetched=0)
+
+    def path(self, key):
+        return os.path.join(self.directory, 'chunk_%d_%d_%d.npy' % key)
+
+    def index_path(self):
+        return os.path.join(self.directory, 'index.npz')
+
+    def load_index(self):
+        if os.path.exists(self.index_path()):
+            with numpy.load(self.index_path()) as index:
+                self.counts = {tuple(int(v) for v in row[:3]): int(row[3])
+                               for row in index['counts']}
+                self.next_node_id = int(index['next_node_id'])
+
+    def save_index(self):
+        counts = numpy.array([key + (count,) for key, count in self.counts.items()],
+                             dtype=numpy.int64).reshape(-1, 4)
+        numpy.savez(self.index_path(), counts=counts, next_node_id=self.next_node_id)
+
+    def claim(self, node_ids):
+        """ Keep node_ids from being handed out again """
+        if len(node_ids):
+            self.next_node_id = max(self.next_node_id, int(numpy.max(node_ids)) + 1)
+
+    def keys_of(self, locations):
+        return numpy.floor(numpy.asarray(locations) / self.chunk_size).astype(numpy.int64)
+
+    def key_of(self, node):
+        return tuple(int(k) for k in self.keys_of(node.translation_matrix[:3, 3]))
+
+    def resident_bytes(self):
+        return len(self.node_chunk) * NODE_BYTES
+
+    def resident_nodes(self):
+        nodes = []
+        for chunk in self.resident.values():
+            nodes.extend(chunk)
+        return nodes
+
+    def read(self, key):
+        if key not in self.counts:
+            return numpy.zeros(0, RECORD)
+        return numpy.load(self.path(key))
+
+    def write_chunk(self, key, records):
+        temp_path = self.path(key) + '.tmp.npy'
+        numpy.save(temp_path, records)
+        os.replace(temp_path, self.path(key))
+        self.counts[key] = len(records)
+        self.stats['writes'] += 1
+
+    def write(self, records):
+        """ Append node records to their chunks on disk, grouped in bulk """
+        self.claim(records['node_id'])
+        keys = self.keys_of(records['location'])
+        order = numpy.lexsort((keys[:, 2], keys[:, 1], keys[:, 0]))
+        keys, records = keys[order], records[order]
+        boundaries = numpy.flatnonzero(numpy.any(keys[1:] != keys[:-1], axis=1)) + 1
+        for group in numpy.split(numpy.arange(len(records)), boundaries):
+            if not len(group):
+                continue
+            key = tuple(int(k) for k in keys[group[0]])
+            if key in self.resident:
+                # the resident copy is the current one, add nodes to it
+                for record in records[group]:
+                    self.adopt(self.make_node(record), key)
+                self.dirty.add(key)
+            else:
+                # a read started before this write would be stale
+                self.reading.pop(key, None)
+                self.write_chunk(key, numpy.concatenate((self.read(key), records[group])))
+        self.save_index()
+
+    def add(self, node):
+        """ Hand a node over to the store """
+        key = self.key_of(node)
+        if key in self.resident:
+            self.claim([node.node_id])
+            self.adopt(node, key)
+            self.dirty.add(key)
+            self.counts.setdefault(key, 0)
+        else:
+            self.write(node_record(node).reshape(1))
+
+    def make_node(self, record):
+        return make_node(SHAPE_NAMES[record['shape']], int(record['node_id']),
+                         int(record['color']), record['location'], float(record['scale']))
+
+    def adopt(self, node, key):
+        self.resident.setdefault(key, []).append(node)
+        self.node_chunk[node] = key
+
+    def on_scene_event(self, event, node):
+        """ Scene listener: remember which resident chunks were edited """
+        key = self.node_chunk.get(node)
+        if key is not None:
+            self.dirty.add(key)
+            if event == 'remove':
+                self.resident[key].remove(node)
+                del self.node_chunk[node]
+
+    def visible(self, camera, forward):
+        """ Return the chunks on disk in view of the camera, nearest first """
+        if not self.counts:
+            return []
+        keys = numpy.array(list(self.counts), dtype=numpy.int64)
+        centers = (keys + 0.5) * self.chunk_size
+        radius = self.chunk_size * math.sqrt(3.0) / 2.0
+        offsets = centers - camera
+        distance = numpy.linalg.norm(offsets, axis=1)
+        along = offsets.dot(forward)
+        across = numpy.sqrt(numpy.maximum(distance * distance - along * along, 0.0))
+        half = math.radians(self.fov / 2.0)
+        # sphere against cone: the chunk's bounding sphere reaches inside the cone
+        in_cone = across * math.cos(half) - along * math.sin(half) <= radius
+        wanted = (distance <= radius) | ((distance <= self.view_distance + radius) & in_cone)
+        order = numpy.argsort(distance[wanted])
+        return [tuple(int(k) for k in key) for key in keys[wanted][order]]
+
+    def update(self, camera, forward, pinned=()):
+        """
+        Page chunks in and out for a camera at position camera looking along
+        the unit vector forward. Chunks holding a pinned node stay resident.
+        Returns whether the set of resident nodes changed.
+        """
+        camera = numpy.asarray(camera, dtype=float)
+        velocity = numpy.zeros(3) if self.last_camera is None else camera - self.last_camera
+        self.last_camera = camera
+
+        wanted = self.visible(camera, forward)
+        visible = set(wanted)
+        ahead = []
+        if velocity.any():
+            predicted = camera + velocity * PREFETCH_FRAMES
+            ahead = [key for key in self.visible(predicted, forward) if key not in visible]
+        keep = visible | set(ahead) | set(self.node_chunk.get(node) for node in pinned)
+
+        # forget reads that are no longer needed
+        for key in list(self.reading):
+            if key not in keep and self.reading[key].done():
+                del self.reading[key]
+
+        missing = [key for key in wanted + ahead if key not in self.resident]
+        changed = self.evict(keep, sum(self.counts[key] for key in missing) * NODE_BYTES)
+        room = self.budget - self.resident_bytes() - self.reading_bytes()
+        for key in missing:
+            if key in self.reading:
+                continue
+            cost = self.counts[key] * NODE_BYTES
+            if cost > room:
+                break
+            room -= cost
+            self.reading[key] = self.reader.submit(self.read, key)
+            if key not in visible:
+                self.stats['prefetched'] += 1
+
+        # visible chunks are waited for, prefetched ones only taken when read
+        loads = 0
+        for key in missing:
+            future = self.reading.get(key)
+            if future is None or loads >= LOADS_PER_UPDATE:
+                continue
+            if key not in visible and not future.done():
+                continue
+            records = future.result()
+            del self.reading[key]
+            self.resident[key] = []
+            for record in records:
+                self.adopt(self.make_node(record), key)
+            self.stats['loads'] += 1
+            loads += 1
+            changed = True
+
+        for key in wanted:
+            if key in self.resident:
+                self.resident.move_to_end(key)
+        return changed
+
+    def reading_bytes(self):
+        return sum(self.counts.get(key, 0) for key in self.reading) * NODE_BYTES
+
+    def evict(self, keep, needed):
+        """ Drop least recently needed chunks outside keep to make room for needed bytes """
+        changed = False
+        for key in list(self.resident):
+            if self.resident_bytes() + needed <= self.budget:
+                break
+            if key in keep:
+                continue
+            self.write_back(key)
+            for node in self.resident.pop(key):
+                del self.node_chunk[node]
+            self.stats['evictions'] += 1
+            changed = True
+        return changed
+
+    def write_back(self, key):
+        """ Store an edited chunk, moving nodes that left it to their new chunk """
+        if key not in self.dirty:
+            return
+        self.dirty.discard(key)
+        staying, leaving = [], []
+        for node in self.resident[key]:
+            (staying if self.key_of(node) == key else leaving).append(node)
+        self.resident[key] = staying
+        records = numpy.array([node_record(node) for node in staying], dtype=RECORD)
+        self.write_chunk(key, records)
+        for node in leaving:
+            del self.node_chunk[node]
+            self.add(node)
+        self.save_index()
+
+    def flush(self):
+        """ Write every edited chunk to disk """
+        for key in list(self.dirty):
+            self.write_back(key)
+
+    def close(self):
+        """ Write the edited chunks and stop the background reader """
+        self.reader.shutdown(wait=True, cancel_futures=True)
+        self.flush()
+
+
+def generate(store, count, extent, seed=0):
+    """
+    Scatter count random nodes over a square site extent units wide, with
+    ids following those already in the store
+    """
+    rng = numpy.random.default_rng(seed)
+    batch = 1000000
+    for start in range(0, count, batch):
+        size = min(batch, count - start)
+        records = numpy.zeros(size, RECORD)
+        records['node_id'] = numpy.arange(store.next_node_id, store.next_node_id + size)
+        records['shape'] = rng.integers(0, len(SHAPE_NAMES), size)
+        records['color'] = rng.integers(0, 10, size)
+        records['location'][:, 0] = rng.uniform(-extent / 2, extent / 2, size)
+        records['location'][:, 2] = rng.uniform(-extent / 2, extent / 2, size)
+        records['scale'] = 1.0
+        store.write(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create or inspect a chunked scene store")
+    parser.add_argument('directory')
+    parser.add_argument('--chunk-size', type=float, default=32.0)
+    parser.add_argument('--generate', type=int, default=0, metavar='COUNT',
+                        help="add COUNT random nodes to the store")
+    parser.add_argument('--extent', type=float, default=2000.0)
+    args = parser.parse_args()
+
+    store = ChunkStore(args.directory, args.chunk_size)
+    if args.generate:
+        generate(store, args.generate, args.extent)
+    print(f"{len(store.counts)} chunks, {sum(store.counts.values())} nodes")
+
+
+if __name__ == "__main__":
+    main()
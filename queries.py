@@ -0,0 +1,181 @@
+"""
+Scene queries that can run off the GLUT thread.
+
+They work on a QuerySnapshot, an immutable array copy of what picking and
+collision tests need from every node, and test all nodes at once with NumPy
+instead of one node at a time.
+"""
+import numpy
+
+from aabb import EPSILON
+from node import Node
+
+
+class QuerySnapshot(object):
+    """ Frozen node transforms and bounds, built by Scene.query_snapshot """
+
+    def __init__(self, nodes):
+        self.nodes = tuple(nodes)
+        count = len(self.nodes)
+        self.translations = numpy.array([n.translation_matrix for n in self.nodes],
+                                        dtype=float).reshape(count, 4, 4)
+        scalings = numpy.array([n.scaling_matrix for n in self.nodes], dtype=float)
+        self.inverse_scalings = numpy.linalg.inv(scalings) if count else scalings.reshape(0, 4, 4)
+        self.centers = numpy.array([n.aabb.center for n in self.nodes], dtype=float).reshape(count, 3)
+        self.sizes = numpy.array([n.aabb.size for n in self.nodes], dtype=float).reshape(count, 3)
+        self.freeze()
+        # row -> FrozenNode of every assembly, so picks never read the live children
+        self.assemblies = {row: FrozenNode(node) for row, node in enumerate(self.nodes)
+                           if getattr(node, 'child_nodes', None)}
+        # node -> row of its arrays, made on the first update
+        self.rows = None
+
+    def arrays(self):
+        return self.translations, self.inverse_scalings, self.centers, self.sizes
+
+    def freeze(self):
+        for array in self.arrays():
+            array.flags.writeable = False
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def copy(self):
+        """ A snapshot of the same nodes whose arrays can be updated apart from these """
+        snapshot = QuerySnapshot.__new__(QuerySnapshot)
+        snapshot.nodes, snapshot.rows = self.nodes, self.rows
+        snapshot.assemblies = dict(self.assemblies)
+        snapshot.translations, snapshot.inverse_scalings, snapshot.centers, snapshot.sizes = \
+            [array.copy() for array in self.arrays()]
+        snapshot.freeze()
+        return snapshot
+
+    def update(self, nodes):
+        """
+        Refresh the rows of nodes in place, so a few changed nodes don't cost
+        a full rebuild. Only for snapshots no other thread can see. Returns
+        False, changing nothing, if one of nodes is not in the snapshot.
+        """
+        if self.rows is None:
+            self.rows = {node: row for row, node in enumerate(self.nodes)}
+        if any(node not in self.rows for node in nodes):
+            return False
+        nodes = list(nodes)
+        if not nodes:
+            return True
+        rows = [self.rows[node] for node in nodes]
+        for array in self.arrays():
+            array.flags.writeable = True
+        self.translations[rows] = [n.translation_matrix for n in nodes]
+        self.inverse_scalings[rows] = numpy.linalg.inv([n.scaling_matrix for n in nodes])
+        self.centers[rows] = [n.aabb.center for n in nodes]
+        self.sizes[rows] = [n.aabb.size for n in nodes]
+        self.freeze()
+        for row, node in zip(rows, nodes):
+            if row in self.assemblies:
+                self.assemblies[row] = FrozenNode(node)
+        return True
+
+    def world_bounds(self):
+        """ Return the (min, max) corners of every node's box in world space """
+        centers = self.translations[:, :3, 3] + self.centers
+        return centers - self.sizes, centers + self.sizes
+
+
+class FrozenNode(object):
+    """ A node's transforms, bounds and children as they were when frozen """
+
+    def __init__(self, node):
+        self.node = node
+        # nodes replace these rather than change them, keeping them is enough
+        self.translation_matrix = node.translation_matrix
+        self.scaling_matrix = node.scaling_matrix
+        self.aabb = node.aabb
+        self.child_nodes = [FrozenNode(child) for child in getattr(node, 'child_nodes', ())]
+
+    pick = Node.pick
+    pick_path = Node.pick_path
+
+    def drill_down(self, start, direction, mat, distance):
+        """ HierarchicalNode.drill_down on the frozen children, the path holds the live nodes """
+        if not self.child_nodes:
+            return [self.node], distance
+        matrix = numpy.dot(numpy.dot(mat, self.translation_matrix), self.scaling_matrix)
+        closest, closest_distance = None, None
+        for child in self.child_nodes:
+            path, distance = child.pick_path(start, direction, matrix)
+            if path is not None and (closest is None or distance < closest_distance):
+                closest, closest_distance = path, distance
+        if closest is None:
+            return None, None
+        return [self.node] + closest, closest_distance
+
+
+def ray_hits(snapshot, start, direction, mat):
+    """
+    Return (hit, distance) arrays for a ray against every node.
+
+    This is AABB.ray_hit run on all nodes at once, with the matrix Node.pick
+    would pass it.
+    """
+    models = numpy.matmul(numpy.matmul(mat, snapshot.translations), snapshot.inverse_scalings)
+    aabb_min = snapshot.centers - snapshot.sizes
+    aabb_max = snapshot.centers + snapshot.sizes
+    count = len(snapshot)
+    tmin = numpy.zeros(count)
+    tmax = numpy.full(count, 100000.0)
+    hit = numpy.ones(count, bool)
+    delta = models[:, :3, 3] - start
+
+    for axis in range(3):
+        axes = models[:, axis, :3]
+        e = numpy.einsum('ij,ij->i', axes, delta)
+        f = axes.dot(direction)
+        slanted = numpy.abs(f) > EPSILON
+        safe_f = numpy.where(slanted, f, 1.0)
+        t1 = (e + aabb_min[:, axis]) / safe_f
+        t2 = (e + aabb_max[:, axis]) / safe_f
+        near, far = numpy.minimum(t1, t2), numpy.maximum(t1, t2)
+        tmax = numpy.where(slanted, numpy.minimum(tmax, far), tmax)
+        tmin = numpy.where(slanted, numpy.maximum(tmin, near), tmin)
+        parallel_miss = (-e + aabb_min[:, axis] > EPSILON) | (-e + aabb_max[:, axis] < -EPSILON)
+        hit &= numpy.where(slanted, tmax >= tmin, ~parallel_miss)
+    return hit, tmin
+
+
+def pick(snapshot, start, direction, mat):
+    """
+    Return (path, distance) of the closest node hit by the ray, or (None, None).
+
+    path leads from a scene node down to the child of an assembly that was
+    hit, see Node.pick_path. Assemblies are drilled into as the snapshot
+    froze them, never through the live nodes being edited meanwhile.
+    """
+    if not len(snapshot):
+        return None, None
+    hit, distance = ray_hits(snapshot, start, direction, mat)
+    closest, closest_distance = None, None
+    for index in numpy.flatnonzero(hit)[numpy.argsort(distance[hit])]:
+        if closest is not None and distance[index] >= closest_distance:
+            break
+        # the bounds were hit, an assembly may still be missed between its parts
+        assembly = snapshot.assemblies.get(index)
+        if assembly is None:
+            path, path_distance = [snapshot.nodes[index]], float(distance[index])
+        else:
+            path, path_distance = assembly.drill_down(start, direction, mat,
+                                                      float(distance[index]))
+        if path is not None and (closest is None or path_distance < closest_distance):
+            closest, closest_distance = path, path_distance
+    return closest, closest_distance
+
+
+def collisions(snapshot, node):
+    """ Return the nodes whose world box overlaps the box node had in the snapshot """
+    if node not in snapshot.nodes:
+        return []
+    index = snapshot.nodes.index(node)
+    low, high = snapshot.world_bounds()
+    overlap = numpy.all((low <= high[index]) & (high >= low[index]), axis=1)
+    overlap[index] = False
+    return [snapshot.nodes[i] for i in numpy.flatnonzero(overlap)]
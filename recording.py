@@ -0,0 +1,221 @@
+"""
+Record the input of an editing session and replay it deterministically.
+
+A Recorder sits between GLUT and an Interaction: it logs every mouse button,
+mouse motion and keystroke with its timestamp and the window size, then
+forwards it. A Replayer feeds a recording back into the same Interaction and
+Viewer callbacks without opening a window, either as fast as possible or at
+the recorded pace, and times every event and every redraw it causes.
+
+    python main.py --record session.rec
+    python recording.py session.rec [--realtime]
+"""
+import argparse
+import atexit
+import contextlib
+import os
+import struct
+import time
+
+import numpy
+
+from backend import GLUT
+from viewer import Viewer
+
+MAGIC = b'IREC'
+VERSION = 1
+HEADER = struct.Struct('<4sHHH')   # magic, version, window width, height
+EVENT = struct.Struct('<dBhhhh')   # time, kind, four arguments
+
+MOUSE_BUTTON = 0  # button, mode, x, y
+MOUSE_MOVE = 1    # x, y
+KEY_BYTES = 2     # key, x, y: keyboard key delivered as bytes
+KEY_STR = 3       # key, x, y: keyboard key delivered as str
+KEY_SPECIAL = 4   # key, x, y: GLUT special key
+RESIZE = 5        # width, height
+
+KIND_NAMES = {
+    MOUSE_BUTTON: 'mouse_button',
+    MOUSE_MOVE: 'mouse_move',
+    KEY_BYTES: 'keystroke',
+    KEY_STR: 'keystroke',
+    KEY_SPECIAL: 'keystroke',
+    RESIZE: 'resize',
+}
+
+
+class Recorder(object):
+    """ Logs the input GLUT delivers to an Interaction """
+
+    def __init__(self, interaction, path):
+        self.interaction = interaction
+        self.window_size = interaction.get_window_size()
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, *self.window_size))
+        self.start = time.perf_counter()
+        atexit.register(self.close)
+
+    def register(self):
+        """ Route GLUT input through the recorder """
+        GLUT.glutMouseFunc(self.handle_mouse_button)
+        GLUT.glutMotionFunc(self.handle_mouse_move)
+        GLUT.glutKeyboardFunc(self.handle_keystroke)
+        GLUT.glutSpecialFunc(self.handle_keystroke)
+
+    def write(self, kind, a=0, b=0, c=0, d=0):
+        self.file.write(EVENT.pack(time.perf_counter() - self.start, kind, a, b, c, d))
+
+    def check_size(self):
+        size = self.interaction.get_window_size()
+        if size != self.window_size:
+            self.window_size = size
+            self.write(RESIZE, size[0], size[1])
+
+    def handle_mouse_button(self, button, mode, x, y):
+        self.check_size()
+        self.write(MOUSE_BUTTON, button, mode, x, y)
+        self.interaction.handle_mouse_button(button, mode, x, y)
+
+    def handle_mouse_move(self, x, y):
+        self.check_size()
+        self.write(MOUSE_MOVE, x, y)
+        self.interaction.handle_mouse_move(x, y)
+
+    def handle_keystroke(self, key, x, y):
+        self.check_size()
+        if isinstance(key, bytes):
+            self.write(KEY_BYTES, key[0], x, y)
+        elif isinstance(key, str):
+            self.write(KEY_STR, ord(key), x, y)
+        else:
+            self.write(KEY_SPECIAL, key, x, y)
+        self.interaction.handle_keystroke(key, x, y)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+def load(path):
+    """ Return (window_size, events) where events is a structured array """
+    with open(path, 'rb') as f:
+        magic, version, width, height = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not an input recording")
+        data = f.read()
+    dtype = numpy.dtype([('time', '<f8'), ('kind', 'u1'), ('args', '<i2', 4)])
+    # a recording cut short by a crash may end in a partial event
+    count = len(data) // EVENT.size
+    return (width, height), numpy.frombuffer(data[:count * EVENT.size], dtype)
+
+
+class HeadlessViewer(Viewer):
+    """
+    A Viewer without a window.
+
+    Rendering only builds the sorted render queue, so frame cost measures
+    the CPU side of a frame and not the driver.
+    """
+    def __init__(self, window_size):
+        self.init_state()
+        self.init_scene()
+        self.init_interaction(headless=True)
+        self.interaction.window_size = window_size
+        self.update_modelview()
+
+    def render(self):
+        self.update_modelview()
+        self.scene.build_render_queue(self.modelView, self.projection_matrix())
+
+
+class Replayer(object):
+    """ Drives a viewer's Interaction from a recording and times it """
+
+    def __init__(self, path, viewer=None):
+        self.window_size, self.events = load(path)
+        self.viewer = viewer or HeadlessViewer(self.window_size)
+        self.interaction = self.viewer.interaction
+        self.latencies = {name: [] for name in set(KIND_NAMES.values())}
+        self.frame_times = []
+        # occlusion culling totals over all frames
+        self.culling = dict(tested=0, occluded=0, outside=0)
+
+    def dispatch(self, kind, args):
+        interaction = self.interaction
+        if kind == MOUSE_BUTTON:
+            interaction.handle_mouse_button(args[0], args[1], args[2], args[3])
+        elif kind == MOUSE_MOVE:
+            interaction.handle_mouse_move(args[0], args[1])
+        elif kind == KEY_BYTES:
+            interaction.handle_keystroke(bytes([args[0]]), args[1], args[2])
+        elif kind == KEY_STR:
+            interaction.handle_keystroke(chr(args[0]), args[1], args[2])
+        elif kind == KEY_SPECIAL:
+            interaction.handle_keystroke(args[0], args[1], args[2])
+        elif kind == RESIZE:
+            interaction.window_size = (args[0], args[1])
+
+    def run(self, realtime=False):
+        """ Replay every event, return the wall clock time it took """
+        start = time.perf_counter()
+        for event in self.events:
+            kind = int(event['kind'])
+            args = [int(a) for a in event['args']]
+            if realtime:
+                delay = event['time'] - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            redisplays = self.interaction.redisplays
+            t0 = time.perf_counter()
+            self.dispatch(kind, args)
+            t1 = time.perf_counter()
+            self.latencies[KIND_NAMES[kind]].append(t1 - t0)
+
+            # GLUT folds every redraw requested by one event into one frame
+            if self.interaction.redisplays != redisplays:
+                self.viewer.render()
+                self.frame_times.append(time.perf_counter() - t1)
+                culler = self.viewer.scene.culler
+                if culler is not None:
+                    for name in self.culling:
+                        self.culling[name] += culler.stats[name]
+        return time.perf_counter() - start
+
+    def report(self, elapsed):
+        print(f"events       {len(self.events)} in {elapsed:.3f} s")
+        for name, latencies in sorted(self.latencies.items()):
+            if not latencies:
+                continue
+            ms = numpy.array(latencies) * 1000.0
+            p50, p95, p99 = numpy.percentile(ms, [50, 95, 99])
+            print(f"{name:12} {len(ms):6d}  p50 {p50:.3f} ms  p95 {p95:.3f} ms  "
+                  f"p99 {p99:.3f} ms  max {ms.max():.3f} ms")
+        frames = numpy.array(self.frame_times) * 1000.0
+        if len(frames):
+            print(f"frames       {len(frames)}  total {frames.sum():.3f} ms  "
+                  f"mean {frames.mean():.3f} ms  max {frames.max():.3f} ms")
+        if self.culling['tested']:
+            print(f"culled       {self.culling['occluded']} occluded  "
+                  f"{self.culling['outside']} outside  of {self.culling['tested']} tested")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay an input recording")
+    parser.add_argument('recording')
+    parser.add_argument('--realtime', action='store_true',
+                        help="keep the recorded pace instead of going flat out")
+    parser.add_argument('--quiet', action='store_true',
+                        help="discard what the scene prints while replaying")
+    args = parser.parse_args()
+
+    with open(os.devnull, 'w') as devnull:
+        output = contextlib.redirect_stdout(devnull) if args.quiet else contextlib.nullcontext()
+        with output:
+            replayer = Replayer(args.recording)
+            elapsed = replayer.run(args.realtime)
+    replayer.report(elapsed)
+
+
+if __name__ == "__main__":
+    main()
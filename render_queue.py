@@ -0,0 +1,139 @@
+"""
+Sorted rendering with redundant GL state elimination.
+
+Instead of every node pushing its matrix and setting its color and material
+as it is drawn, nodes submit draw items to a RenderQueue. At the end of the
+frame the queue sorts them by polygon mode, primitive, material and color and
+issues them in that order, only calling GL when the state actually changes.
+"""
+import numpy
+
+from backend import GL
+from primitive import G_OBJ_CUBE
+from transformation import scaling, translation
+
+# polygon modes, kept as plain values so sorting never touches GL
+GL_FILL_MODE = 0
+GL_LINE_MODE = 1
+# sorts in place of the display list of a mesh not compiled yet
+UNCOMPILED = -1
+
+SELECTED_EMISSION = (0.3, 0.3, 0.3)
+NO_EMISSION = (0.0, 0.0, 0.0)
+
+# GL calls Node.render makes per primitive: push, 2 mult, color, call, pop
+CALLS_PER_NODE = 6
+# GL calls Node.render makes around the children of a HierarchicalNode: push, 2 mult, color, pop
+CALLS_PER_GROUP = 5
+# GL calls AABB.render makes: 2 polygon mode, matrix mode, push, translate, call, pop
+CALLS_PER_BOUNDS = 7
+
+
+class RenderQueue(object):
+    """ Draw items of one frame """
+
+    def __init__(self):
+        self.clear()
+        # GL calls issued and avoided during the last flush
+        self.stats = dict(items=0, issued=0, avoided=0)
+
+    def clear(self):
+        self.keys = []
+        self.matrices = []
+        self.order = None
+        self.transforms = None
+        self.view = None
+        # calls the per node render path would have made for these items
+        self.baseline = 0
+        # item index -> MeshNode whose display list flush compiles
+        self.uncompiled = dict()
+
+    def submit(self, call_list, matrix, color, selected, mesh=None):
+        """
+        Queue a display list drawn with the given model matrix. A call_list
+        of None is compiled from mesh when flushed, the only time GL is used.
+        """
+        if call_list is None:
+            self.uncompiled[len(self.keys)] = mesh
+            call_list = UNCOMPILED
+        emission = SELECTED_EMISSION if selected else NO_EMISSION
+        self.keys.append((GL_FILL_MODE, call_list, emission, color))
+        self.matrices.append(matrix)
+        self.baseline += CALLS_PER_NODE + (2 if selected else 0)
+
+    def submit_group(self, selected):
+        """ Count the calls a HierarchicalNode makes around its children """
+        self.baseline += CALLS_PER_GROUP + (2 if selected else 0)
+
+    def submit_bounds(self, aabb, matrix):
+        """ Queue the wireframe of a bounding box, for debugging """
+        self.keys.append((GL_LINE_MODE, G_OBJ_CUBE, NO_EMISSION, None))
+        # the cube display list is one unit wide, size is a half extent
+        box = numpy.dot(translation(aabb.center), scaling(aabb.size * 2.0))
+        self.matrices.append(numpy.dot(matrix, box))
+        self.baseline += CALLS_PER_BOUNDS
+
+    def prepare(self, view):
+        """ Sort the items by state and compute their modelview matrices """
+        self.view = view
+        self.order = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+        if self.matrices:
+            self.transforms = numpy.matmul(view, numpy.array(self.matrices))
+
+    def flush(self):
+        """ Issue the GL calls for the prepared items """
+        state = GLState()
+        for index in self.order:
+            mode, call_list, emission, color = self.keys[index]
+            if call_list == UNCOMPILED:
+                call_list = self.uncompiled[index].display_list()
+            state.polygon_mode(mode)
+            state.emission(emission)
+            if color is not None:
+                state.color(color)
+            GL.glLoadMatrixd(numpy.transpose(self.transforms[index]))
+            GL.glCallList(call_list)
+            state.issued += 2
+
+        state.restore()
+        if self.view is not None:
+            GL.glLoadMatrixd(numpy.transpose(self.view))
+            state.issued += 1
+
+        self.stats = dict(items=len(self.order), issued=state.issued,
+                          avoided=max(self.baseline - state.issued, 0))
+
+
+class GLState(object):
+    """ The GL state set so far this frame, None when unknown """
+
+    def __init__(self):
+        self.current = dict(mode=None, emission=None, color=None)
+        self.issued = 0
+
+    def changed(self, name, value):
+        if self.current[name] == value:
+            return False
+        self.current[name] = value
+        self.issued += 1
+        return True
+
+    def restore(self):
+        """ Leave GL as the code drawing after the scene expects it """
+        if self.current['emission'] not in (None, NO_EMISSION):
+            self.emission(NO_EMISSION)
+        if self.current['mode'] not in (None, GL_FILL_MODE):
+            self.polygon_mode(GL_FILL_MODE)
+
+    def polygon_mode(self, mode):
+        if self.changed('mode', mode):
+            GL.glPolygonMode(GL.GL_FRONT_AND_BACK,
+                             GL.GL_LINE if mode == GL_LINE_MODE else GL.GL_FILL)
+
+    def emission(self, emission):
+        if self.changed('emission', emission):
+            GL.glMaterialfv(GL.GL_FRONT, GL.GL_EMISSION, emission)
+
+    def color(self, color):
+        if self.changed('color', color):
+            GL.glColor3f(color[0], color[1], color[2])
@@ -0,0 +1,293 @@
+"""
+Procedural duplication and scattering of nodes.
+
+Arrays repeat a node along a line, over a grid or around a circle; scatters
+spread new spheres and cubes over a box, uniformly at random or as Poisson
+disk samples no closer than a given distance. Locations, scales, colors and
+shapes are generated as whole arrays, and nodes are built from a template
+without running Node.__init__ for each one, so a million nodes take seconds.
+The results go into the scene with one Scene.add_nodes call.
+"""
+import copy
+import gc
+import math
+
+import numpy
+
+import color
+from aabb import AABB
+from node import Primitive
+from scene import SHAPES
+from transformation import translation
+
+# shapes a scatter picks from by default
+SCATTER_SHAPES = ('sphere', 'cube')
+# neighbour cells looked up per batch of Poisson disk darts, sets the batch size
+POISSON_LOOKUPS = 1 << 20
+# darts thrown per active square before the squares are split
+POISSON_DARTS_PER_SQUARE = 2
+# splits of the grid cells, the uncovered space left after the last is negligible
+POISSON_MAX_LEVELS = 6
+
+
+def linear_offsets(count, step):
+    """ count offsets step apart along a line, the first one step from the origin """
+    return numpy.arange(1, count + 1)[:, None] * numpy.asarray(step, dtype=float)
+
+
+def grid_offsets(counts, spacing):
+    """
+    Offsets of a counts[0] x counts[1] x counts[2] grid, spacing apart on
+    each axis, with a corner at the origin
+    """
+    axes = [numpy.arange(count) * step for count, step in zip(counts, spacing)]
+    return numpy.stack(numpy.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+
+
+def radial_offsets(count, radius, axis=1, angle=2.0 * math.pi):
+    """
+    count offsets around a circle of radius about the origin, in the plane
+    across axis, spread evenly over angle radians
+    """
+    # a full circle does not repeat its first position at the end
+    steps = count if math.isclose(angle, 2.0 * math.pi) else max(count - 1, 1)
+    theta = numpy.arange(count) * (angle / steps)
+    first, second = [a for a in range(3) if a != axis]
+    offsets = numpy.zeros((count, 3))
+    offsets[:, first] = radius * numpy.cos(theta)
+    offsets[:, second] = radius * numpy.sin(theta)
+    return offsets
+
+
+def random_points(count, low, high, rng):
+    """ count points uniformly distributed in the box low, high """
+    return rng.uniform(low, high, (count, 3))
+
+
+def poisson_points(radius, low, high, rng, limit=None):
+    """
+    Points in the box low, high no two closer than radius, by dart throwing.
+    Axes where low equals high are left out, so a flat box gives a 2D
+    pattern.
+
+    A background grid of cells too small to hold two points finds the
+    neighbours of a whole batch of darts at once; darts too close to each
+    other in the same batch are dropped in favour of the one thrown first.
+    Darts go only into active squares, which start as the empty cells. Once
+    each has had a few darts the squares are split, and the halves lying
+    inside the disk of a placed point are dropped, so the last gaps are
+    found quickly and the result is close to maximal: hardly any point
+    could still be added.
+    """
+    low = numpy.asarray(low, dtype=float)
+    high = numpy.asarray(high, dtype=float)
+    axes = numpy.flatnonzero(high > low)
+    if not len(axes):
+        return low[None, :].copy()
+    dimensions = len(axes)
+    cell = radius / math.sqrt(dimensions)
+    extent = (high - low)[axes]
+    shape = numpy.maximum(numpy.ceil(extent / cell).astype(int), 1)
+    # cells as far as reach away may hold a point closer than radius
+    reach = math.ceil(math.sqrt(dimensions))
+    # index into points of the point in each cell, -1 for none; the border
+    # of reach empty cells lets neighbours be found without bounds checks
+    padded = tuple(shape + 2 * reach)
+    grid = numpy.full(padded, -1, dtype=numpy.int64)
+    around = numpy.stack(numpy.meshgrid(*[numpy.arange(-reach, reach + 1)] * dimensions,
+                                        indexing='ij'), axis=-1).reshape(-1, dimensions)
+    around = numpy.ravel_multi_index(tuple((around + reach).T), padded) \
+        - numpy.ravel_multi_index((reach,) * dimensions, padded)
+    corners = numpy.stack(numpy.meshgrid(*[[0.0, 1.0]] * dimensions, indexing='ij'),
+                          axis=-1).reshape(-1, dimensions)
+    points = numpy.empty((0, dimensions))
+    most = max(POISSON_LOOKUPS // len(around), 1)
+
+    def grid_cells(positions):
+        """ Flat index into grid of the cell holding each position """
+        cells = numpy.minimum((positions / cell).astype(numpy.int64), shape - 1)
+        return numpy.ravel_multi_index(tuple((cells + reach).T), padded)
+
+    def place(points):
+        """ The points as locations in the box """
+        locations = numpy.repeat(low[None, :], len(points), axis=0)
+        locations[:, axes] += points
+        return locations
+
+    def too_close(candidates, found, others):
+        """ Whether each candidate is within radius of one of the others it found """
+        rows, columns = numpy.nonzero(found >= 0)
+        near = others[found[rows, columns]] - candidates[rows]
+        close = numpy.zeros(len(candidates), dtype=bool)
+        close[rows[(near ** 2).sum(axis=1) < radius ** 2]] = True
+        return close
+
+    def split(origins, size):
+        """
+        Halve each square of size at origins on every axis, return the
+        origins of the halves not inside the disk of a single placed point
+        """
+        half = size / 2.0
+        kept = []
+        for start in range(0, len(origins), most):
+            square = origins[start:start + most]
+            # the halves lie in the grid cell of their square, and share its neighbours
+            found = grid.ravel()[grid_cells(square + half)[:, None] + around]
+            rows, columns = numpy.nonzero(found >= 0)
+            near = points[found[rows, columns]] - square[rows]
+            # a point covering a half is within radius of its center
+            distance = radius + half / 2.0 * math.sqrt(dimensions)
+            close = ((near - half) ** 2).sum(axis=1) < distance ** 2
+            rows, near = rows[close], near[close]
+            covered = numpy.zeros((len(square), len(corners)), dtype=bool)
+            for index, corner in enumerate(corners):
+                # the corner of the half farthest from the point is within radius
+                far = numpy.abs(near - corner * half - half / 2.0) + half / 2.0
+                covered[rows[(far ** 2).sum(axis=1) < radius ** 2], index] = True
+            halves = square[:, None, :] + corners * half
+            kept.append(halves[~covered & (halves < extent).all(axis=2)])
+        return numpy.concatenate(kept) if kept else origins
+
+    # lower corners of the squares darts are thrown into, and their size
+    origins = numpy.stack(numpy.unravel_index(numpy.arange(numpy.prod(shape)), tuple(shape)),
+                          axis=1) * cell
+    size = cell
+    # batch index of the candidate kept in each cell, -1 for none
+    taken = numpy.full(padded, -1, dtype=numpy.int64)
+    for level in range(POISSON_MAX_LEVELS + 1):
+        for _ in range(POISSON_DARTS_PER_SQUARE):
+            # one dart into each square, in random order
+            shuffled = origins[rng.permutation(len(origins))]
+            for start in range(0, len(shuffled), most):
+                candidates = shuffled[start:start + most]
+                batch = len(candidates)
+                candidates = numpy.minimum(candidates + rng.random((batch, dimensions)) * size,
+                                           extent)
+                flat = grid_cells(candidates)
+                lookup = flat[:, None] + around
+                # against the points already placed
+                keep = ~too_close(candidates, grid.ravel()[lookup], points)
+                # one candidate per cell, then against each other
+                first = numpy.zeros(batch, dtype=bool)
+                first[numpy.unique(numpy.where(keep, flat, -1), return_index=True)[1]] = True
+                keep &= first
+                taken.ravel()[flat[keep]] = numpy.flatnonzero(keep)
+                found = taken.ravel()[lookup]
+                taken.ravel()[flat[keep]] = -1
+                earlier = numpy.where(found < numpy.arange(batch)[:, None], found, -1)
+                keep &= ~too_close(candidates, earlier, candidates)
+
+                accepted = candidates[keep]
+                if limit is not None:
+                    accepted = accepted[:limit - len(points)]
+                grid.ravel()[flat[keep][:len(accepted)]] = len(points) + numpy.arange(len(accepted))
+                points = numpy.concatenate((points, accepted))
+                if limit is not None and len(points) >= limit:
+                    return place(points)
+            # a cell holding a point has no room left for another
+            origins = origins[grid.ravel()[grid_cells(origins + size / 2.0)] < 0]
+        if not len(origins) or level == POISSON_MAX_LEVELS:
+            break
+        # split the squares, keeping the parts still uncovered
+        origins = split(origins, size)
+        size /= 2.0
+    return place(points)
+
+
+def build_nodes(template, locations, scales=None, colors=None):
+    """
+    Return copies of template at locations, with the given uniform scales
+    and color indices, by default those of the template. Primitives are
+    copied without constructing them and share every array they can, which
+    is safe because nodes replace their matrices and bounds, never write
+    into them. Assemblies are deep copied one by one.
+    """
+    count = len(locations)
+    base_scale = template.scaling_matrix[0, 0]
+    scales = numpy.full(count, base_scale) if scales is None else numpy.asarray(scales, dtype=float)
+    colors = numpy.full(count, template.color_index) if colors is None else colors
+
+    if not isinstance(template, Primitive):
+        nodes = []
+        for location, scale, color_index in zip(locations, scales.tolist(), colors.tolist()):
+            node = copy.deepcopy(template)
+            unselect(node)
+            node.node_id = None
+            node.translation_matrix = translation(location)
+            node.scale_to(scale)
+            node.color_index = color_index
+            nodes.append(node)
+        return nodes
+
+    translations = numpy.tile(numpy.identity(4), (count, 1, 1))
+    translations[:, :3, 3] = locations
+    # one scaling matrix and pair of bound arrays for each distinct scale
+    unique, which = numpy.unique(scales, return_inverse=True)
+    scalings = numpy.tile(numpy.identity(4), (len(unique), 1, 1))
+    scalings[:, [0, 1, 2], [0, 1, 2]] = unique[:, None]
+    centers = template.aabb.center / base_scale * unique[:, None]
+    sizes = template.aabb.size / base_scale * unique[:, None]
+    scalings, centers, sizes = list(scalings), list(centers), list(sizes)
+
+    state = dict(template.__dict__, selected=False, node_id=None, parent=None)
+    cls = type(template)
+    new_node, new_aabb = cls.__new__, AABB.__new__
+    nodes = []
+    # none of the new objects is garbage, don't let the collector keep scanning them
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        for matrix, index, color_index in zip(translations, which.tolist(), colors.tolist()):
+            node = new_node(cls)
+            aabb = new_aabb(AABB)
+            aabb.center, aabb.size = centers[index], sizes[index]
+            node.__dict__.update(state)
+            node.aabb = aabb
+            node.translation_matrix = matrix
+            node.scaling_matrix = scalings[index]
+            node.color_index = color_index
+            nodes.append(node)
+    finally:
+        if collecting:
+            gc.enable()
+    return nodes
+
+
+def unselect(node):
+    node.selected = False
+    for child in getattr(node, 'child_nodes', ()):
+        unselect(child)
+
+
+def array(scene, node, offsets):
+    """
+    Add copies of node moved by each offset to the scene, return them.
+    A zero offset is the node itself and gets no copy.
+    """
+    offsets = offsets[numpy.any(offsets != 0.0, axis=1)]
+    nodes = build_nodes(node, node.translation_matrix[:3, 3] + offsets)
+    scene.add_nodes(nodes)
+    return nodes
+
+
+def scatter(scene, locations, shapes=SCATTER_SHAPES, scale_range=(1.0, 1.0), rng=None):
+    """
+    Add nodes of random shapes, scales and colors at locations to the
+    scene, return them in the order of locations
+    """
+    rng = numpy.random.default_rng() if rng is None else rng
+    count = len(locations)
+    kinds = rng.integers(0, len(shapes), count)
+    scales = rng.uniform(scale_range[0], scale_range[1], count)
+    colors = rng.integers(color.MIN_COLOR, color.MAX_COLOR + 1, count)
+    nodes = [None] * count
+    for kind, shape in enumerate(shapes):
+        chosen = numpy.flatnonzero(kinds == kind)
+        if not len(chosen):
+            continue
+        template = SHAPES[shape]()
+        built = build_nodes(template, locations[chosen], scales[chosen], colors[chosen])
+        for index, node in zip(chosen.tolist(), built):
+            nodes[index] = node
+    scene.add_nodes(nodes)
+    return nodes
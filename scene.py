@@ -1,12 +1,40 @@
-import sys
+import threading
 
 import numpy
+import queries
 from node import Cube, Sphere, SnowFigure
+from occlusion import OcclusionCuller
+from render_queue import RenderQueue
+from spatial import SpatialHash, world_bounds
+from transformation import translation
+
+# shapes that can be placed into the scene by name
+SHAPES = {
+    'sphere': Sphere,
+    'cube': Cube,
+    'figure': SnowFigure,
+}
+
+def make_node(shape, node_id, color_index, location, scale):
+    """ Build a node from the state the sync service and chunk store keep """
+    node = SHAPES[shape]()
+    node.node_id = node_id
+    node.color_index = color_index
+    node.translation_matrix = translation(location)
+    node.scale_to(scale)
+    return node
 
 class Scene(object):
 
     # The default depth from the camera to place an object
     PLACE_DEPTH = 15.0
+    # the ground grid drawn by G_OBJ_PLANE, in the y = 0 plane
+    GRID_STEP = 0.5
+    GRID_EXTENT = 10.0
+    # how close to a grid line, face or center a dragged node is pulled to it
+    SNAP_DISTANCE = 0.25
+    # neighbours looked at per snap, keeps drags constant time in dense scenes
+    SNAP_NEIGHBORS = 32
 
     def __init__(self):
         # the camera keeps list of nodes being displayed
@@ -14,18 +42,215 @@ class Scene(object):
         # Keep track of currently selected nodes 
         # action may depend on currently selected node
         self.selected_node = None
+        # the scene node holding the selection, selected_node or its ancestor
+        self.selected_root = None
+        # select the part of an assembly under the cursor, not the assembly
+        self.pick_children = False
+        # snap dragged nodes to the grid and to their neighbours
+        self.snapping = True
+        # where the dragged node would be without snapping
+        self.drag_location = None
+        # SpatialHash of node_list, built when first needed
+        self.spatial = None
+        # nodes by their node_id
+        self.node_index = dict()
+        # functions called with (event, node) whenever the scene is mutated
+        self.listeners = list()
+        # next identifier handed out by add_node
+        self.next_node_id = 0
+        # draw items of the current frame, sorted by GL state
+        self.render_queue = RenderQueue()
+        # draw the bounding box of every node, for debugging
+        self.show_bounds = False
+        # skips nodes hidden behind others, None draws every node
+        self.culler = OcclusionCuller()
+        # QuerySnapshot of the current state, dropped on every mutation
+        self.snapshot_cache = None
+        # nodes changed since snapshot_cache was brought up to date
+        self.snapshot_changes = set()
+        # whether snapshot_cache was handed to another thread, and must not change
+        self.snapshot_shared = False
+        # paged ChunkStore for scenes too large for memory, see paging.py
+        self.store = None
+
+        # live snapshots, see snapshot.py; the lock guards them and their saved state
+        self.snapshots = list()
+        self.snapshot_lock = threading.Lock()
+        # node_list is also held by a snapshot, copy it before changing it
+        self.node_list_shared = False
+        # nodes added or changed, and ids removed, since the last freeze
+        self.modified = set()
+        self.removed = set()
+        self.generation = 0
 
         print("scene")
 
+    def add_listener(self, function):
+        """ Register a function to be told about every scene mutation """
+        self.listeners.append(function)
+
+    def notify(self, event, node):
+        # colors are not in the query snapshot
+        if event in ('move', 'scale'):
+            self.snapshot_changes.add(node)
+        elif event != 'color':
+            self.snapshot_cache = None
+        if self.spatial is not None and event not in ('color', 'remove'):
+            self.spatial.update(node)
+        for function in self.listeners:
+            function(event, node)
+
     def add_node(self, node):
+        if node.node_id is None:
+            node.node_id = self.next_node_id
+            self.next_node_id += 1
+        self.own_node_list()
         self.node_list.append(node)
+        self.node_index[node.node_id] = node
+        self.modified.add(node)
+        self.notify('add', node)
 
         print(f"add node {node}")
 
-    def render(self):
-        """Render scene """
+    def add_nodes(self, nodes):
+        """ Add many nodes as one batch, those with an id keep it """
+        self.own_node_list()
+        next_node_id = self.next_node_id
+        for node in nodes:
+            if node.node_id is None:
+                node.node_id = next_node_id
+            next_node_id = max(next_node_id, node.node_id + 1)
+        self.next_node_id = next_node_id
+        self.node_list.extend(nodes)
+        self.node_index.update((node.node_id, node) for node in nodes)
+        self.modified.update(nodes)
+        self.snapshot_cache = None
+        if self.spatial is not None:
+            self.spatial.insert_many(nodes)
+        for function in self.listeners:
+            for node in nodes:
+                function('add', node)
+
+        print(f"add {len(nodes)} nodes")
+
+    def remove_node(self, node):
+        """ Take a top level node, or one paged in from the store, out of the scene """
+        if node is self.selected_root:
+            self.clear_selection()
+        if node in self.node_list:
+            self.own_node_list()
+            self.node_list.remove(node)
+        self.node_index.pop(node.node_id, None)
+        self.modified.discard(node)
+        self.removed.add(node.node_id)
+        if self.spatial is not None:
+            self.spatial.remove(node)
+        self.notify('remove', node)
+
+        print(f"remove node {node}")
+
+    def remove_selected(self):
+        if self.selected_root is None: return
+        self.remove_node(self.selected_root)
+
+    def renumber_nodes(self, next_node_id):
+        """
+        Give every node a new id counting up from next_node_id. Saving sees
+        each node changed under its new id, and the old ids no node took
+        over removed.
+        """
+        old_ids = set(node.node_id for node in self.node_list)
+        self.node_index = dict()
         for node in self.node_list:
-            node.render()
+            node.node_id = next_node_id
+            next_node_id += 1
+            self.node_index[node.node_id] = node
+            self.modified.add(node)
+        self.next_node_id = next_node_id
+        # an id removed and taken again is saved as the node holding it now
+        self.removed.update(old_ids)
+        self.removed.difference_update(self.node_index)
+
+    def own_node_list(self):
+        """ Copy node_list before changing it if a snapshot holds it """
+        if self.node_list_shared:
+            self.node_list = list(self.node_list)
+            self.node_list_shared = False
+
+    def before_write(self, node):
+        """ Called before node changes, lets the snapshots keep its old state """
+        self.modified.add(node)
+        if self.snapshots:
+            with self.snapshot_lock:
+                for snapshot in self.snapshots:
+                    snapshot.capture(node)
+
+    def attach_store(self, store):
+        """ Show the resident nodes of a ChunkStore along with node_list """
+        self.store = store
+        # new nodes must not take the id of one in the store
+        self.next_node_id = max(self.next_node_id, store.next_node_id)
+        self.add_listener(store.on_scene_event)
+        self.snapshot_cache = None
+
+    def active_nodes(self):
+        """ The nodes in memory: node_list and the store's resident chunks """
+        if self.store is None:
+            return self.node_list
+        return self.node_list + self.store.resident_nodes()
+
+    def update_paging(self, camera, forward):
+        """ Page store chunks in and out for the camera, keeping the selection """
+        if self.store is None: return
+        pinned = [self.selected_root] if self.selected_root is not None else []
+        if self.store.update(camera, forward, pinned):
+            self.snapshot_cache = None
+
+    def render(self, view, projection=None):
+        """Render scene with view as the modelview matrix """
+        self.build_render_queue(view, projection)
+        self.render_queue.flush()
+
+    def build_render_queue(self, view, projection=None):
+        """
+        Collect and sort this frame's draw items without touching GL.
+        Nodes are occlusion culled when the projection is given.
+        """
+        queue = self.render_queue
+        queue.clear()
+        identity = numpy.identity(4)
+        if projection is not None and self.culler is not None:
+            # the snapshot is reused until the scene changes
+            nodes = self.culler.cull(self.query_snapshot(shared=False), view, projection)
+        else:
+            nodes = self.active_nodes()
+        for node in nodes:
+            node.submit(queue, identity)
+            if self.show_bounds:
+                queue.submit_bounds(node.aabb, node.translation_matrix)
+        queue.prepare(view)
+
+    def query_snapshot(self, shared=True):
+        """
+        An immutable copy of the scene for queries on other threads. Nodes
+        changed since it was last asked for are updated row by row, in place
+        unless a copy was shared; pass shared=False when the copy is only
+        used on this thread before the scene next changes.
+        """
+        snapshot = self.snapshot_cache
+        if snapshot is not None and self.snapshot_changes:
+            if self.snapshot_shared:
+                snapshot = snapshot.copy()
+                self.snapshot_shared = False
+            if not snapshot.update(self.snapshot_changes):
+                snapshot = None
+        if snapshot is None:
+            snapshot = queries.QuerySnapshot(self.active_nodes())
+            self.snapshot_shared = False
+        self.snapshot_cache = snapshot
+        self.snapshot_changes = set()
+        self.snapshot_shared = self.snapshot_shared or shared
+        return snapshot
 
     def pick(self, start, direction, mat):
         """ 
@@ -34,34 +259,47 @@ class Scene(object):
         start, direction describe a Ray. 
         mat is the inverse of the current modelview matrix for the scene.
         """
+        self.clear_selection()
+        path, distance = queries.pick(self.query_snapshot(shared=False), start, direction, mat)
+        self.select_hit(path, distance, start, direction)
+
+    def clear_selection(self):
         if self.selected_node is not None:
             self.selected_node.select(False)
             self.selected_node = None
+            self.selected_root = None
+        self.drag_location = None
 
-        # keep track of closest hit
-        mindist = sys.maxsize
-        closest_node = None
-        for node in self.node_list:
-            hit, distance = node.pick(start, direction, mat)
-            if hit and distance < mindist:
-                mindist, closest_node = distance, node
+    def spatial_index(self):
+        if self.spatial is None:
+            self.spatial = SpatialHash()
+            self.spatial.insert_many(self.node_list)
+        return self.spatial
 
+    def select_hit(self, path, distance, start, direction):
+        """ Select the node at the end of a pick path hit at distance along the ray """
         # if we hit something keep track of it
-        if closest_node is not None:
-            closest_node.select()
-            closest_node.depth = mindist
-            closest_node.selected_loc = start + direction * mindist
-            self.selected_node = closest_node
+        if path is not None:
+            node = path[-1] if self.pick_children else path[0]
+            node.select()
+            node.depth = distance
+            node.selected_loc = start + direction * distance
+            self.selected_node = node
+            self.selected_root = path[0]
 
     def rotate_selected_color(self, forwards):
         """ Rotate the color of the currently selected node """
         if self.selected_node is None: return
+        self.before_write(self.selected_root)
         self.selected_node.rotate_color(forwards)
+        self.notify('color', self.selected_root)
 
     def scale_selected(self, up):
         """ Scale the current selection """
         if self.selected_node is None: return
+        self.before_write(self.selected_root)
         self.selected_node.scale(up)
+        self.notify('scale', self.selected_root)
 
     def move_selected(self, start, direction, inv_modelview):
         """ 
@@ -87,8 +325,50 @@ class Scene(object):
         translation = inv_modelview.dot(pre_tran)
 
         # translate the node and track its location
+        self.before_write(self.selected_root)
+        if self.snapping and node is self.selected_root:
+            if self.drag_location is None:
+                self.drag_location = node.translation_matrix[:3, 3].copy()
+            self.drag_location += translation[:3]
+            translation = self.snap(node, self.drag_location) - node.translation_matrix[:3, 3]
         node.translate(translation[0], translation[1], translation[2])
         node.selected_loc = newloc
+        self.notify('move', self.selected_root)
+
+    def snap(self, node, location):
+        """
+        Return where node should go when dragged to location: each axis is
+        pulled to a neighbour's face or center within SNAP_DISTANCE, else x
+        and z to the grid and y to resting on the ground.
+        """
+        center, size = node.aabb.center, node.aabb.size
+        low, high = location + center - size, location + center + size
+        snapped = location.copy()
+        snapped[[0, 2]] = numpy.round(location[[0, 2]] / self.GRID_STEP) * self.GRID_STEP
+        resting = size[1] - center[1]
+        if abs(location[1] - resting) <= self.SNAP_DISTANCE:
+            snapped[1] = resting
+
+        neighbors = self.spatial_index().nearby(low - self.SNAP_DISTANCE,
+                                                high + self.SNAP_DISTANCE,
+                                                self.SNAP_NEIGHBORS + 1)
+        neighbors.discard(node)
+        if not neighbors:
+            return snapped
+        bounds = numpy.array([world_bounds(n) for n in neighbors])
+        other_low, other_high = bounds[:, 0], bounds[:, 1]
+        # offsets lining up centers, touching faces and flush faces
+        offsets = numpy.stack([
+            (other_low + other_high) / 2.0 - (low + high) / 2.0,
+            other_high - low, other_low - high,
+            other_low - low, other_high - high,
+        ]).reshape(-1, 3)
+        distance = numpy.abs(offsets)
+        closest = numpy.argmin(distance, axis=0)
+        for axis in range(3):
+            if distance[closest[axis], axis] <= self.SNAP_DISTANCE:
+                snapped[axis] = location[axis] + offsets[closest[axis], axis]
+        return snapped
 
     def place(self, shape, start, direction, inv_modelview):
         """ 
@@ -99,18 +379,102 @@ class Scene(object):
         start, direction describes the Ray to move to
         inv_modelview is the inverse modelview matrix for the scene 
         """
-        new_node = None
-        if shape == 'sphere': new_node = Sphere()
-        elif shape == 'cube': new_node = Cube()
-        elif shape == 'figure': new_node = SnowFigure()
+        new_node = SHAPES[shape]()
+
+        # rest the node on what is under the cursor, in world space
+        origin = inv_modelview.dot(numpy.append(start, 1.0))[:3]
+        ray = inv_modelview.dot(numpy.append(direction, 0.0))[:3]
+        translation = self.surface_location(new_node, origin, ray)
 
+        if translation is None:
+            # place the node at the cursor in camera-space
+            translation = (start + direction * self.PLACE_DEPTH)
+
+            # convert the translation to world-space
+            pre_tran = numpy.array([translation[0], translation[1], translation[2], 1])
+            translation = inv_modelview.dot(pre_tran)
+
+        new_node.translate(translation[0], translation[1], translation[2])
+
+        # add once positioned so listeners see the final placement
         self.add_node(new_node)
 
-        # place the node at the cursor in camera-space
-        translation = (start + direction * self.PLACE_DEPTH)
+    def surface_location(self, node, origin, ray):
+        """
+        Return where node rests on the first surface the world space ray
+        meets, a node's face or the ground grid, or None if it meets neither
+        """
+        hit, distance, normal = self.spatial_index().raycast(origin, ray)
+        ground = None
+        if ray[1] < 0.0:
+            ground = -origin[1] / ray[1]
+            point = origin + ray * ground
+            if numpy.abs(point[[0, 2]]).max() > self.GRID_EXTENT:
+                ground = None
+        center, size = node.aabb.center, node.aabb.size
+
+        if hit is not None and (ground is None or distance <= ground):
+            # against the face hit, centered on it when close
+            location = origin + ray * distance - center + normal * size
+            hit_low, hit_high = world_bounds(hit)
+            for axis in numpy.flatnonzero(normal == 0):
+                middle = (hit_low[axis] + hit_high[axis]) / 2.0 - center[axis]
+                if abs(location[axis] - middle) <= self.SNAP_DISTANCE:
+                    location[axis] = middle
+            return location
+        if ground is not None:
+            # standing on the grid, at the closest grid point
+            location = origin + ray * ground - center
+            location[[0, 2]] = numpy.round(location[[0, 2]] / self.GRID_STEP) * self.GRID_STEP
+            location[1] = size[1] - center[1]
+            return location
+        return None
 
-        # convert the translation to world-space
-        pre_tran = numpy.array([translation[0], translation[1], translation[2], 1])
-        translation = inv_modelview.dot(pre_tran)
+    def apply_remote(self, event, node_id, shape=None, color_index=None,
+                     location=None, scale=None):
+        """
+        Apply a mutation made by another editor.
+
+        Listeners are not notified, so changes received from the sync
+        service are never echoed back to it.
+        """
+        if event == 'add':
+            self.snapshot_cache = None
+            node = make_node(shape, node_id, color_index, location, scale)
+            self.own_node_list()
+            self.node_list.append(node)
+            self.node_index[node_id] = node
+            self.modified.add(node)
+            if self.spatial is not None:
+                self.spatial.insert(node)
+            return
 
-        new_node.translate(translation[0], translation[1], translation[2])
\ No newline at end of file
+        node = self.node_index.get(node_id)
+        if node is None: return
+        if event == 'remove':
+            self.snapshot_cache = None
+            if node is self.selected_root:
+                self.clear_selection()
+            if node in self.node_list:
+                self.own_node_list()
+                self.node_list.remove(node)
+            del self.node_index[node_id]
+            self.modified.discard(node)
+            self.removed.add(node_id)
+            if self.spatial is not None:
+                self.spatial.remove(node)
+            return
+        self.before_write(node)
+        if location is not None or scale is not None:
+            self.snapshot_changes.add(node)
+        if color_index is not None:
+            node.color_index = color_index
+        if location is not None:
+            node.translation_matrix = translation(location)
+            # a drag in progress continues from where the node was moved to
+            if node is self.selected_root:
+                self.drag_location = None
+        if scale is not None:
+            node.scale_to(scale)
+        if self.spatial is not None:
+            self.spatial.update(node)
@@ -0,0 +1,126 @@
+"""
+Frame pacing for the viewer.
+
+Instead of redrawing whenever an input callback asks for it, the viewer runs
+a fixed budget frame loop on a GLUT timer. Each tick applies the input that
+arrived since the last one, latest first wins for repeated moves, collects
+finished background queries and remote edits, and draws at most one frame.
+FrameStats keeps the recent frame times for the overlay and for scripts.
+"""
+import time
+import traceback
+from collections import OrderedDict, deque
+
+import numpy
+
+from backend import GLUT
+
+FRAME_RATE = 60
+# frames kept by FrameStats
+WINDOW = 240
+
+
+class FrameStats(object):
+    """ Rolling window of frame times """
+
+    def __init__(self, budget, window=WINDOW):
+        # seconds one frame may take
+        self.budget = budget
+        # seconds spent drawing each frame
+        self.times = deque(maxlen=window)
+        # frame periods missed by each frame
+        self.missed = deque(maxlen=window)
+        self.frames = 0
+
+    def add(self, start, end, requested=None):
+        """
+        Record a frame drawn from start to end, perf_counter seconds. A frame
+        finished more than a period after it was requested dropped the
+        frames that should have been shown in between.
+        """
+        self.times.append(end - start)
+        waited = end - (start if requested is None else requested)
+        self.missed.append(int(waited // self.budget))
+        self.frames += 1
+
+    def summary(self):
+        """ Statistics of the frames in the window, times in milliseconds """
+        if not self.times:
+            return dict(frames=self.frames, window=0, mean=0.0, p50=0.0, p95=0.0,
+                        p99=0.0, max=0.0, dropped=0, over_budget=0)
+        ms = numpy.array(self.times) * 1000.0
+        p50, p95, p99 = numpy.percentile(ms, [50, 95, 99])
+        return dict(frames=self.frames, window=len(ms), mean=float(ms.mean()),
+                    p50=float(p50), p95=float(p95), p99=float(p99), max=float(ms.max()),
+                    dropped=int(sum(self.missed)),
+                    over_budget=int((ms > self.budget * 1000.0).sum()))
+
+    def lines(self):
+        """ The summary as text for the overlay """
+        s = self.summary()
+        return [
+            f"frame  p50 {s['p50']:.1f}  p95 {s['p95']:.1f}  p99 {s['p99']:.1f} ms",
+            f"budget {self.budget * 1000.0:.1f} ms  over {s['over_budget']}  "
+            f"dropped {s['dropped']}  of {s['window']}",
+        ]
+
+
+class FrameScheduler(object):
+    """ Drives a Viewer's redraws from a GLUT timer """
+
+    def __init__(self, viewer, frame_rate=FRAME_RATE):
+        self.viewer = viewer
+        self.budget = 1.0 / frame_rate
+        self.stats = FrameStats(self.budget)
+        # a redraw was asked for since the last frame
+        self.dirty = True
+        # input applied once per frame, the latest call of each name wins
+        self.deferred = OrderedDict()
+        self.tick_start = None
+        # when the frame being waited for was posted, None when drawn
+        self.posted = None
+
+    def start(self):
+        GLUT.glutTimerFunc(0, self.tick, 0)
+
+    def request_redraw(self):
+        self.dirty = True
+
+    def defer(self, name, function, *args):
+        """ Call function(*args) at the next tick, replacing earlier calls of name """
+        self.deferred.pop(name, None)
+        self.deferred[name] = (function, args)
+        self.dirty = True
+
+    def frame_drawn(self, start, end):
+        self.stats.add(start, end, self.posted)
+        self.posted = None
+
+    def tick(self, value):
+        self.tick_start = time.perf_counter()
+        try:
+            while self.deferred:
+                name, (function, args) = self.deferred.popitem(last=False)
+                self.call(name, function, *args)
+            if self.call('bus', self.viewer.interaction.bus.drain):
+                self.dirty = True
+            if self.viewer.sync is not None and self.call('sync', self.viewer.sync.poll):
+                self.dirty = True
+            if self.dirty:
+                self.dirty = False
+                if self.posted is None:
+                    self.posted = self.tick_start
+                GLUT.glutPostRedisplay()
+        finally:
+            # keep the cadence, the time spent in this tick comes off the wait
+            elapsed = time.perf_counter() - self.tick_start
+            GLUT.glutTimerFunc(max(int((self.budget - elapsed) * 1000.0), 0), self.tick, 0)
+
+    def call(self, name, function, *args):
+        """ Call function(*args), printing what it raises so the frame loop goes on """
+        try:
+            return function(*args)
+        except Exception:
+            print(f"frame scheduler: {name} failed")
+            traceback.print_exc()
+            return None
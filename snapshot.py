@@ -0,0 +1,300 @@
+"""
+Copy-on-write scene snapshots, autosave and export.
+
+freeze(scene) returns a Snapshot in constant time: it shares the scene's
+node list and nodes instead of copying them. The scene copies its node list
+the first time it is changed afterwards, and hands every node's old state
+to the live snapshots just before the node changes. Node transforms are
+replaced on every change, never written in place, so the old state is only
+three references. A snapshot can then be written out on another thread
+while editing goes on.
+
+Every snapshot also carries the nodes changed since the one before it, so
+Autosave writes a full base file only now and then and otherwise small
+journal files holding just those nodes. Each journal is stamped with the
+generation of the base it follows, so journals left behind by a base
+rewrite that was cut short are never replayed on top of the newer base.
+"""
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy
+
+from node import MeshNode
+from scene import SHAPES, make_node
+
+RECORD = numpy.dtype([
+    ('node_id', '<u8'),
+    ('shape', 'u1'),
+    ('color', 'u1'),
+    ('location', '<f8', (3,)),
+    ('scale', '<f8'),
+])
+SHAPE_NAMES = sorted(SHAPES) + ['mesh']
+SHAPE_CODES = {name: code for code, name in enumerate(SHAPE_NAMES)}
+
+# nodes read per hold of the scene's snapshot lock
+READ_BATCH = 1024
+# journals written before the next autosave rewrites the base file
+JOURNALS_PER_BASE = 50
+AUTOSAVE_INTERVAL = 30.0
+
+
+class Snapshot(object):
+    """ The scene as it was when frozen, readable from any thread """
+
+    def __init__(self, scene, nodes, modified, removed, generation):
+        self.scene = scene
+        # the scene's node list as it was, the scene copies before changing it
+        self.nodes = nodes
+        # nodes added or changed, and ids removed, since the previous snapshot
+        self.modified = modified
+        self.removed = removed
+        self.generation = generation
+        # state of the nodes changed after the freeze, as it was before
+        self.saved = dict()
+
+    def capture(self, node):
+        """ Keep the state node has before its first change, scene lock held """
+        if node not in self.saved:
+            self.saved[node] = state(node)
+
+    def states(self, nodes):
+        """ Yield (node, state) of nodes as they were when frozen """
+        lock = self.scene.snapshot_lock
+        for start in range(0, len(nodes), READ_BATCH):
+            with lock:
+                batch = [(node, self.saved.get(node) or state(node))
+                         for node in nodes[start:start + READ_BATCH]]
+            yield from batch
+
+    def records(self, nodes=None):
+        """ Return (records, mesh ids, mesh paths) of nodes, by default all of them """
+        nodes = self.nodes if nodes is None else nodes
+        records = numpy.zeros(len(nodes), RECORD)
+        mesh_ids, mesh_paths = [], []
+        for i, (node, (color_index, translation_matrix, scaling_matrix)) in \
+                enumerate(self.states(nodes)):
+            records[i] = (node.node_id, SHAPE_CODES[node.shape], color_index,
+                          translation_matrix[:3, 3], scaling_matrix[0, 0])
+            if node.shape == 'mesh':
+                mesh_ids.append(node.node_id)
+                mesh_paths.append(node.path)
+        return records, numpy.array(mesh_ids, dtype='<u8'), numpy.array(mesh_paths, dtype=str)
+
+    def write(self, path, nodes=None, removed=(), base=None):
+        """
+        Store records of nodes, and the ids removed, in an .npz file. base
+        is the generation of the base file a journal follows, by default
+        this snapshot's own for a base file.
+        """
+        records, mesh_ids, mesh_paths = self.records(nodes)
+        temp_path = path + '.tmp.npz'
+        base = self.generation if base is None else base
+        numpy.savez(temp_path, generation=self.generation, base=base, records=records,
+                    removed=numpy.array(sorted(removed), dtype='<u8'),
+                    mesh_ids=mesh_ids, mesh_paths=mesh_paths)
+        os.replace(temp_path, path)
+
+    def release(self):
+        """ Stop keeping old node state for this snapshot """
+        with self.scene.snapshot_lock:
+            if self in self.scene.snapshots:
+                self.scene.snapshots.remove(self)
+        self.saved.clear()
+
+
+def freeze(scene, track_changes=True):
+    """
+    Return a copy-on-write Snapshot of the scene's nodes, in constant time.
+    With track_changes it takes over the scene's record of the nodes changed
+    since the last such freeze, for incremental saving.
+    """
+    if track_changes:
+        snapshot = Snapshot(scene, scene.node_list, scene.modified, scene.removed,
+                            scene.generation)
+        scene.modified, scene.removed = set(), set()
+    else:
+        snapshot = Snapshot(scene, scene.node_list, set(), set(), scene.generation)
+    scene.node_list_shared = True
+    scene.generation += 1
+    with scene.snapshot_lock:
+        scene.snapshots.append(snapshot)
+    return snapshot
+
+
+def state(node):
+    return node.color_index, node.translation_matrix, node.scaling_matrix
+
+
+def read(path):
+    """ Return (records, removed ids, {node_id: mesh path}) of a written snapshot """
+    with numpy.load(path) as data:
+        meshes = dict(zip(data['mesh_ids'].tolist(), data['mesh_paths'].tolist()))
+        return data['records'], data['removed'], meshes
+
+
+def read_stamp(path):
+    """
+    Return (generation, base generation) of a written snapshot. Files
+    written before journals were stamped follow any base.
+    """
+    with numpy.load(path) as data:
+        generation = int(data['generation'])
+        base = int(data['base']) if 'base' in data.files else None
+        return generation, base
+
+
+def build_nodes(records, meshes):
+    """ Make the nodes described by snapshot records """
+    nodes = []
+    for record in records:
+        node_id = int(record['node_id'])
+        shape = SHAPE_NAMES[record['shape']]
+        if shape == 'mesh':
+            node = MeshNode(meshes[node_id])
+            node.node_id = node_id
+            node.color_index = int(record['color'])
+            node.translate(*record['location'])
+            node.scale_to(float(record['scale']))
+        else:
+            node = make_node(shape, node_id, int(record['color']),
+                             record['location'], float(record['scale']))
+        nodes.append(node)
+    return nodes
+
+
+def export(scene, path, executor=None):
+    """ Write the whole scene to path in the background, return the future """
+    snapshot = freeze(scene, track_changes=False)
+
+    def write():
+        try:
+            snapshot.write(path)
+        finally:
+            snapshot.release()
+    if executor is not None:
+        return executor.submit(write)
+    executor = ThreadPoolExecutor(1, thread_name_prefix='export')
+    future = executor.submit(write)
+    # the thread finishes the export, then exits
+    executor.shutdown(wait=False)
+    return future
+
+
+class Autosave(object):
+    """ Saves a scene to a directory incrementally on a background thread """
+
+    def __init__(self, scene, directory):
+        self.scene = scene
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='autosave')
+        self.pending = None
+        # (modified, removed) of a snapshot that failed to be written
+        self.unsaved = None
+        self.journals = len(self.journal_paths())
+        # number of the next journal, they are applied in this order
+        self.sequence = self.journals and int(self.journal_paths()[-1][-10:-4]) + 1
+        # generation of the base file, journals are stamped with it
+        self.base_generation = -1
+        if os.path.exists(self.base_path()):
+            self.base_generation = read_stamp(self.base_path())[0]
+            # later bases must have later generations than any saved so far
+            scene.generation = max(scene.generation, self.base_generation + 1)
+
+    def base_path(self):
+        return os.path.join(self.directory, 'base.npz')
+
+    def journal_paths(self):
+        return sorted(glob.glob(os.path.join(self.directory, 'journal-*.npz')))
+
+    def load(self):
+        """ Add the saved nodes to the scene, return how many there were """
+        if not os.path.exists(self.base_path()):
+            return 0
+        records, removed, meshes = read(self.base_path())
+        current = {int(r['node_id']): r for r in records}
+        for path in self.journal_paths():
+            generation, base = read_stamp(path)
+            if base is not None and base < self.base_generation:
+                # written before the base was rewritten, already in it
+                os.remove(path)
+                self.journals -= 1
+                continue
+            records, removed, journal_meshes = read(path)
+            meshes.update(journal_meshes)
+            for node_id in removed.tolist():
+                current.pop(node_id, None)
+            for record in records:
+                current[int(record['node_id'])] = record
+        nodes = build_nodes(list(current.values()), meshes)
+        self.scene.add_nodes(nodes)
+        # what was loaded is already saved
+        freeze(self.scene).release()
+        return len(nodes)
+
+    def save(self):
+        """
+        Freeze the scene and write what changed since the last save in the
+        background. Returns the future, or None while a save is still running.
+        """
+        if self.pending is not None and not self.pending.done():
+            return None
+        full = self.journals >= JOURNALS_PER_BASE or not os.path.exists(self.base_path())
+        snapshot = freeze(self.scene)
+        if self.unsaved is not None:
+            # retry the changes of the failed write, later changes win
+            modified, removed = self.unsaved
+            self.unsaved = None
+            snapshot.removed = (removed - set(node.node_id for node in snapshot.modified)) \
+                | snapshot.removed
+            snapshot.modified = modified | snapshot.modified
+        if not full and not snapshot.modified and not snapshot.removed:
+            snapshot.release()
+            return None
+        self.pending = self.executor.submit(self.write, snapshot, full)
+        return self.pending
+
+    def write(self, snapshot, full):
+        try:
+            if full:
+                snapshot.write(self.base_path())
+                # journals of the old base are skipped on load if this is cut short
+                self.base_generation = snapshot.generation
+                for path in self.journal_paths():
+                    os.remove(path)
+                self.journals = self.sequence = 0
+            else:
+                changed = [node for node in snapshot.modified
+                           if node.node_id not in snapshot.removed]
+                path = os.path.join(self.directory, 'journal-%06d.npz' % self.sequence)
+                snapshot.write(path, changed, snapshot.removed, self.base_generation)
+                self.journals += 1
+                self.sequence += 1
+        except Exception as error:
+            # keep the changes for the next save
+            self.unsaved = snapshot.modified, snapshot.removed
+            print(f"autosave to {self.directory} failed: {error}")
+            raise
+        finally:
+            snapshot.release()
+
+    def export(self, path):
+        """ Write the whole scene to one file, on the autosave thread """
+        return export(self.scene, path, self.executor)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def close(self):
+        """ Save the changes made since the last save, then stop the writer """
+        try:
+            if self.pending is not None:
+                wait([self.pending])
+            future = self.save()
+            if future is not None:
+                future.result()
+        finally:
+            self.shutdown()
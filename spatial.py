@@ -0,0 +1,211 @@
+"""
+Uniform spatial hash over the world bounds of nodes.
+
+World space is cut into cubic cells and every node is listed in the cells
+its box overlaps, so the nodes near a point or along a ray are found by
+looking at a handful of cells, however many nodes the scene holds. Scene
+uses it to place nodes onto the surface under the cursor and to snap
+dragged nodes to their neighbours.
+"""
+import math
+from collections import defaultdict
+
+import numpy
+
+CELL_SIZE = 2.0
+# nodes overlapping more cells are kept aside and checked by every query
+MAX_CELLS = 64
+# the ray is followed through at most this many cells
+MAX_STEPS = 4096
+
+
+def world_bounds(node):
+    """ Return the (min, max) corners of a scene node's box in world space """
+    center = node.translation_matrix[:3, 3] + node.aabb.center
+    return center - node.aabb.size, center + node.aabb.size
+
+
+def ray_box(origin, direction, low, high):
+    """
+    Return (distance, normal) where the ray enters the box, or (None, None).
+    normal is the outward normal of the face entered.
+    """
+    near, far = -math.inf, math.inf
+    normal = None
+    for axis in range(3):
+        if direction[axis] == 0.0:
+            if not low[axis] <= origin[axis] <= high[axis]:
+                return None, None
+            continue
+        t1 = (low[axis] - origin[axis]) / direction[axis]
+        t2 = (high[axis] - origin[axis]) / direction[axis]
+        if t1 > t2:
+            t1, t2 = t2, t1
+        if t1 > near:
+            near = t1
+            normal = numpy.zeros(3)
+            normal[axis] = -1.0 if direction[axis] > 0 else 1.0
+        far = min(far, t2)
+        if near > far:
+            return None, None
+    if near < 0.0 or normal is None:
+        return None, None
+    return near, normal
+
+
+class SpatialHash(object):
+
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        # cell key -> nodes overlapping it
+        self.cells = defaultdict(set)
+        # node -> (low key, high key) of the cells it is listed in
+        self.node_keys = dict()
+        self.large = set()
+        # corners of the region holding nodes, for clipping rays
+        self.low = numpy.full(3, numpy.inf)
+        self.high = numpy.full(3, -numpy.inf)
+
+    def __len__(self):
+        return len(self.node_keys)
+
+    def key(self, point):
+        return tuple(int(k) for k in numpy.floor(numpy.asarray(point) / self.cell_size))
+
+    def cell_keys(self, low_key, high_key):
+        for i in range(low_key[0], high_key[0] + 1):
+            for j in range(low_key[1], high_key[1] + 1):
+                for k in range(low_key[2], high_key[2] + 1):
+                    yield i, j, k
+
+    def insert(self, node):
+        low, high = world_bounds(node)
+        low_key, high_key = self.key(low), self.key(high)
+        self.node_keys[node] = (low_key, high_key)
+        self.low = numpy.minimum(self.low, low)
+        self.high = numpy.maximum(self.high, high)
+        if numpy.prod(numpy.subtract(high_key, low_key) + 1) > MAX_CELLS:
+            self.large.add(node)
+            return
+        for key in self.cell_keys(low_key, high_key):
+            self.cells[key].add(node)
+
+    def insert_many(self, nodes):
+        """ Insert nodes, their bounds and cells computed together """
+        if not nodes:
+            return
+        centers = numpy.array([node.translation_matrix[:3, 3] + node.aabb.center for node in nodes])
+        sizes = numpy.array([node.aabb.size for node in nodes])
+        lows, highs = centers - sizes, centers + sizes
+        self.low = numpy.minimum(self.low, lows.min(axis=0))
+        self.high = numpy.maximum(self.high, highs.max(axis=0))
+        low_keys = numpy.floor(lows / self.cell_size).astype(int)
+        high_keys = numpy.floor(highs / self.cell_size).astype(int)
+        large = numpy.prod(high_keys - low_keys + 1, axis=1) > MAX_CELLS
+        single = (low_keys == high_keys).all(axis=1)
+        cells = self.cells
+        for node, low_key, high_key, is_large, is_single in zip(
+                nodes, map(tuple, low_keys.tolist()), map(tuple, high_keys.tolist()),
+                large.tolist(), single.tolist()):
+            self.node_keys[node] = (low_key, high_key)
+            if is_large:
+                self.large.add(node)
+            elif is_single:
+                cells[low_key].add(node)
+            else:
+                for key in self.cell_keys(low_key, high_key):
+                    cells[key].add(node)
+
+    def remove(self, node):
+        keys = self.node_keys.pop(node, None)
+        if keys is None:
+            return
+        if node in self.large:
+            self.large.discard(node)
+            return
+        for key in self.cell_keys(*keys):
+            cell = self.cells[key]
+            cell.discard(node)
+            if not cell:
+                del self.cells[key]
+
+    def update(self, node):
+        """ Move node to the cells of its current bounds """
+        low, high = world_bounds(node)
+        if self.node_keys.get(node) == (self.key(low), self.key(high)) and node not in self.large:
+            # same cells, only the region may have grown
+            self.low = numpy.minimum(self.low, low)
+            self.high = numpy.maximum(self.high, high)
+            return
+        self.remove(node)
+        self.insert(node)
+
+    def nearby(self, low, high, limit=None):
+        """ Return the nodes listed in the cells overlapping the box, at most limit """
+        found = set(self.large)
+        for key in self.cell_keys(self.key(low), self.key(high)):
+            cell = self.cells.get(key)
+            if cell:
+                found.update(cell)
+            if limit is not None and len(found) >= limit:
+                break
+        return found
+
+    def raycast(self, origin, direction, skip=()):
+        """
+        Return (node, distance, normal) of the first node box the ray enters,
+        or (None, None, None). Cells are visited in order along the ray and
+        the walk stops as soon as no later cell can hold a closer hit.
+        """
+        origin = numpy.asarray(origin, dtype=float)
+        direction = numpy.asarray(direction, dtype=float)
+        best = (None, None, None)
+        tested = set(skip)
+
+        def test(nodes):
+            nonlocal best
+            for node in nodes:
+                if node in tested:
+                    continue
+                tested.add(node)
+                distance, normal = ray_box(origin, direction, *world_bounds(node))
+                if distance is not None and (best[1] is None or distance < best[1]):
+                    best = (node, distance, normal)
+
+        test(self.large)
+        if not self.cells:
+            return best
+        # start where the ray reaches the region holding nodes
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            t1 = (self.low - origin) / direction
+            t2 = (self.high - origin) / direction
+        near = numpy.nanmax(numpy.where(direction != 0, numpy.minimum(t1, t2), -numpy.inf))
+        far = numpy.nanmin(numpy.where(direction != 0, numpy.maximum(t1, t2), numpy.inf))
+        if near > far or far < 0:
+            return best
+        t = max(near, 0.0)
+
+        # walk the cells the ray passes through (Amanatides and Woo)
+        key = numpy.array(self.key(origin + direction * t))
+        step = numpy.sign(direction).astype(int)
+        # an axis the ray runs along is never crossed
+        moving = step != 0
+        delta = numpy.abs(numpy.divide(self.cell_size, direction, out=numpy.full(3, numpy.inf),
+                                       where=moving))
+        boundary = (key + (step > 0)) * self.cell_size
+        next_t = numpy.divide(boundary - origin, direction, out=numpy.full(3, numpy.inf),
+                              where=moving)
+        for _ in range(MAX_STEPS):
+            cell = self.cells.get(tuple(int(k) for k in key))
+            if cell:
+                test(cell)
+            axis = int(numpy.argmin(next_t))
+            exit_t = next_t[axis]
+            # hits found so far are before any point of the cells still ahead
+            if best[1] is not None and best[1] <= exit_t:
+                break
+            if exit_t > far:
+                break
+            key[axis] += step[axis]
+            next_t[axis] += delta[axis]
+        return best
@@ -0,0 +1,119 @@
+"""
+Cold start report.
+
+Times the import of every module in a fresh interpreter, checks that the
+core modules (scene graph, math, picking) never pull in PyOpenGL, and times
+how long main.py takes to put its first frame on screen.
+
+    python startup.py [--repeat 5] [--json] [--check]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# modules usable by batch tools, they must only need NumPy
+CORE_MODULES = ['transformation', 'aabb', 'trackball', 'node', 'scene']
+# modules that may bring the rendering backend in when used
+UI_MODULES = ['interaction', 'viewer']
+
+FIRST_FRAME_MARKER = 'FIRST_FRAME'
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'opengl': 'OpenGL' in sys.modules}}))
+'''
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def first_frame_reached():
+    """ Tell startup.py the first frame is drawn, then quit straight away """
+    print(FIRST_FRAME_MARKER, flush=True)
+    os._exit(0)
+
+
+def measure_import(module, repeat):
+    """ Return (median seconds, whether OpenGL got imported) """
+    times = []
+    opengl = False
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', PROBE.format(module=module)],
+                                cwd=HERE, capture_output=True, text=True, check=True)
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        times.append(result['seconds'])
+        opengl = opengl or result['opengl']
+    return statistics.median(times), opengl
+
+
+def measure_interpreter(repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def measure_first_frame(timeout):
+    """ Seconds from launching main.py to its first frame, None without a display """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, 'main.py', '--exit-after-first-frame'],
+                               cwd=HERE, stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL, text=True)
+    try:
+        for line in process.stdout:
+            if line.strip() == FIRST_FRAME_MARKER:
+                return time.perf_counter() - start
+            if time.perf_counter() - start > timeout:
+                break
+        return None
+    finally:
+        process.kill()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report cold start times")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    parser.add_argument('--check', action='store_true',
+                        help="exit with an error if a core module imports OpenGL")
+    args = parser.parse_args()
+
+    report = {'interpreter': measure_interpreter(args.repeat), 'imports': {}}
+    for module in CORE_MODULES + UI_MODULES:
+        seconds, opengl = measure_import(module, args.repeat)
+        report['imports'][module] = {'seconds': seconds, 'opengl': opengl,
+                                     'core': module in CORE_MODULES}
+    report['first_frame'] = measure_first_frame(args.timeout)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{'interpreter':16} {report['interpreter'] * 1000:8.1f} ms")
+        for module, result in report['imports'].items():
+            note = 'loads OpenGL' if result['opengl'] else ''
+            print(f"import {module:14} {result['seconds'] * 1000:5.1f} ms  {note}")
+        first_frame = report['first_frame']
+        if first_frame is None:
+            print("first frame      unavailable (no display?)")
+        else:
+            print(f"first frame      {first_frame * 1000:8.1f} ms")
+
+    if args.check:
+        leaks = [m for m, r in report['imports'].items() if r['core'] and r['opengl']]
+        if leaks:
+            print("core modules importing OpenGL: " + ', '.join(leaks), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
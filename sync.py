@@ -0,0 +1,393 @@
+"""
+Scene synchronisation between several editors on the same machine.
+
+A SyncServer keeps the authoritative copy of the shared scene. Editors send
+the mutations their Scene produces as compact binary deltas; the server
+coalesces them per tick (only the latest move, scale or color of a node
+survives) and broadcasts one batch to every editor. Editors that join late
+receive a snapshot of the scene plus the batches sent since it was taken.
+
+Run a standalone server with:  python sync.py --port 7420
+"""
+import argparse
+import asyncio
+import queue
+import struct
+import threading
+import time
+
+# frame header: message type, payload length
+FRAME = struct.Struct('<BI')
+MSG_WELCOME = 1   # server -> editor: assigned client id
+MSG_SNAPSHOT = 2  # server -> editor: full scene state as delta records
+MSG_BATCH = 3     # server -> editor: coalesced deltas of one tick
+MSG_DELTAS = 4    # editor -> server: deltas produced locally
+
+WELCOME = struct.Struct('<I')
+# batch header: flush time, number of origin groups
+BATCH = struct.Struct('<dI')
+# origin group header: editor that made the change, size of its records
+GROUP = struct.Struct('<II')
+
+# delta records, every record starts with its opcode and the node id
+OP_ADD = 0
+OP_MOVE = 1
+OP_SCALE = 2
+OP_COLOR = 3
+OP_REMOVE = 4
+RECORDS = {
+    OP_ADD: struct.Struct('<BQBB3ff'),  # shape, color, location, scale
+    OP_MOVE: struct.Struct('<BQ3f'),    # location
+    OP_SCALE: struct.Struct('<BQf'),    # uniform scale
+    OP_COLOR: struct.Struct('<BQB'),    # color index
+    OP_REMOVE: struct.Struct('<BQ'),
+}
+EVENTS = {'add': OP_ADD, 'move': OP_MOVE, 'scale': OP_SCALE, 'color': OP_COLOR,
+          'remove': OP_REMOVE}
+
+SHAPE_CODES = {'sphere': 0, 'cube': 1, 'figure': 2}
+SHAPE_NAMES = {code: name for name, code in SHAPE_CODES.items()}
+
+# editors whose socket buffer grows beyond this are too slow and get dropped
+MAX_WRITE_BUFFER = 4 * 1024 * 1024
+# seconds an editor waits for the server to welcome it
+CONNECT_TIMEOUT = 10.0
+
+
+def encode_delta(event, node):
+    """ Encode a Scene notification as a delta record """
+    op = EVENTS[event]
+    location = node.translation_matrix[:3, 3]
+    if op == OP_ADD:
+        return RECORDS[op].pack(op, node.node_id, SHAPE_CODES[node.shape],
+                                node.color_index, location[0], location[1],
+                                location[2], node.scaling_matrix[0, 0])
+    if op == OP_MOVE:
+        return RECORDS[op].pack(op, node.node_id, location[0], location[1],
+                                location[2])
+    if op == OP_SCALE:
+        return RECORDS[op].pack(op, node.node_id, node.scaling_matrix[0, 0])
+    if op == OP_REMOVE:
+        return RECORDS[op].pack(op, node.node_id)
+    return RECORDS[op].pack(op, node.node_id, node.color_index)
+
+
+def iter_records(payload):
+    """ Yield (op, node_id, record) for every delta record in payload """
+    offset = 0
+    while offset < len(payload):
+        op = payload[offset]
+        size = RECORDS[op].size
+        record = payload[offset:offset + size]
+        yield op, struct.unpack_from('<Q', record, 1)[0], record
+        offset += size
+
+
+def apply_record(scene, op, record):
+    """ Apply one delta record to a scene without notifying its listeners """
+    values = RECORDS[op].unpack(record)
+    node_id = values[1]
+    if op == OP_ADD:
+        scene.apply_remote('add', node_id, shape=SHAPE_NAMES[values[2]],
+                           color_index=values[3], location=values[4:7],
+                           scale=values[7])
+    elif op == OP_MOVE:
+        scene.apply_remote('move', node_id, location=values[2:5])
+    elif op == OP_SCALE:
+        scene.apply_remote('scale', node_id, scale=values[2])
+    elif op == OP_REMOVE:
+        scene.apply_remote('remove', node_id)
+    else:
+        scene.apply_remote('color', node_id, color_index=values[2])
+
+
+class DeltaBatch(object):
+    """
+    Deltas collected during one tick.
+
+    A later record for the same node and opcode replaces the earlier one, so
+    a drag produces a single move per tick however many motion events it had.
+    """
+    def __init__(self):
+        self.records = dict()
+        self.received = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, origin, payload):
+        for op, node_id, record in iter_records(payload):
+            self.records[(op, node_id)] = (origin, record)
+            self.received += 1
+
+    def encode(self, timestamp):
+        """ Return the batch frame, records grouped by originating editor """
+        groups = dict()
+        for origin, record in self.records.values():
+            groups.setdefault(origin, []).append(record)
+        parts = [BATCH.pack(timestamp, len(groups))]
+        for origin, records in groups.items():
+            data = b''.join(records)
+            parts.append(GROUP.pack(origin, len(data)))
+            parts.append(data)
+        return encode_frame(MSG_BATCH, b''.join(parts))
+
+
+def encode_frame(message, payload):
+    return FRAME.pack(message, len(payload)) + payload
+
+
+def decode_batch(payload, skip_origin=None):
+    """
+    Return (timestamp, records) for a batch frame payload.
+    records is the concatenation of every group not sent by skip_origin.
+    """
+    timestamp, count = BATCH.unpack_from(payload, 0)
+    offset = BATCH.size
+    records = []
+    for _ in range(count):
+        origin, size = GROUP.unpack_from(payload, offset)
+        offset += GROUP.size
+        if origin != skip_origin:
+            records.append(payload[offset:offset + size])
+        offset += size
+    return timestamp, b''.join(records)
+
+
+async def read_frame(reader):
+    header = await reader.readexactly(FRAME.size)
+    message, size = FRAME.unpack(header)
+    return message, await reader.readexactly(size)
+
+
+class SyncServer(object):
+    """ Authoritative scene state shared by every connected editor """
+
+    def __init__(self, host='127.0.0.1', port=0, tick=1.0 / 60,
+                 snapshot_every=300):
+        self.host = host
+        self.port = port
+        # seconds between two broadcasts
+        self.tick = tick
+        # ticks between two snapshots for late joiners
+        self.snapshot_every = snapshot_every
+        self.writers = dict()
+        self.handlers = set()
+        self.next_client_id = 1
+        self.pending = DeltaBatch()
+        # latest record of each (op, node_id), this is the whole scene
+        self.state = dict()
+        self.snapshot = encode_frame(MSG_SNAPSHOT, b'')
+        # batch frames sent since the snapshot was taken
+        self.tail = []
+        self.ticks = 0
+        self.stats = dict(records_in=0, records_out=0, batches=0,
+                          bytes_out=0, dropped_clients=0)
+        self.server = None
+        self.ticker = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_client,
+                                                 self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.ticker = asyncio.ensure_future(self.run_ticks())
+
+    async def stop(self):
+        self.ticker.cancel()
+        self.server.close()
+        for writer in list(self.writers.values()):
+            writer.close()
+        # closed sockets make every handler see end of stream and return
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def handle_client(self, reader, writer):
+        client_id = self.next_client_id
+        self.next_client_id += 1
+        # a joiner gets the snapshot and tail before any new batch
+        writer.write(encode_frame(MSG_WELCOME, WELCOME.pack(client_id)))
+        writer.write(self.snapshot)
+        for frame in self.tail:
+            writer.write(frame)
+        self.writers[client_id] = writer
+        self.handlers.add(asyncio.current_task())
+        try:
+            while True:
+                message, payload = await read_frame(reader)
+                if message == MSG_DELTAS:
+                    self.pending.add(client_id, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writers.pop(client_id, None)
+            self.handlers.discard(asyncio.current_task())
+            writer.close()
+
+    async def run_ticks(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self.flush()
+
+    def flush(self):
+        """ Broadcast the deltas of the current tick as a single batch """
+        self.ticks += 1
+        if self.ticks % self.snapshot_every == 0:
+            self.take_snapshot()
+        if not len(self.pending):
+            return
+        batch, self.pending = self.pending, DeltaBatch()
+        frame = batch.encode(time.perf_counter())
+        for key, (origin, record) in batch.records.items():
+            if key[0] == OP_REMOVE:
+                # a removed node leaves the scene state altogether
+                for op in RECORDS:
+                    self.state.pop((op, key[1]), None)
+            else:
+                self.state[key] = record
+        self.tail.append(frame)
+
+        self.stats['records_in'] += batch.received
+        self.stats['records_out'] += len(batch)
+        self.stats['batches'] += 1
+        for client_id, writer in list(self.writers.items()):
+            if writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+                self.writers.pop(client_id)
+                writer.close()
+                self.stats['dropped_clients'] += 1
+                continue
+            writer.write(frame)
+            self.stats['bytes_out'] += len(frame)
+
+    def take_snapshot(self):
+        """ Fold the tail into a new snapshot so joiners replay less """
+        self.snapshot = encode_frame(MSG_SNAPSHOT, b''.join(self.state.values()))
+        self.tail = []
+
+
+class SyncConnection(object):
+    """ One editor's connection to a SyncServer """
+
+    def __init__(self):
+        self.client_id = None
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        message, payload = await read_frame(self.reader)
+        self.client_id = WELCOME.unpack(payload)[0]
+
+    def send(self, records):
+        self.writer.write(encode_frame(MSG_DELTAS, records))
+
+    async def receive(self):
+        """ Return (timestamp, records) of the next snapshot or batch """
+        message, payload = await read_frame(self.reader)
+        if message == MSG_SNAPSHOT:
+            return None, payload
+        return decode_batch(payload, skip_origin=self.client_id)
+
+    def close(self):
+        self.writer.close()
+
+
+class SyncClient(object):
+    """
+    Connects a Scene to a SyncServer.
+
+    The network runs on a background thread. Local mutations are coalesced
+    and sent once per tick; remote ones are queued until poll() applies them
+    on the thread that owns the scene.
+    """
+    def __init__(self, scene, host='127.0.0.1', port=7420, tick=1.0 / 60):
+        self.scene = scene
+        self.host = host
+        self.port = port
+        self.tick = tick
+        self.connection = SyncConnection()
+        self.outgoing = dict()
+        self.outgoing_lock = threading.Lock()
+        self.incoming = queue.Queue()
+        self.connected = threading.Event()
+        # why connecting failed, raised by start
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.connected.wait()
+        if self.error is not None:
+            raise self.error
+        # give nodes created before connecting ids no other editor uses
+        self.scene.renumber_nodes(self.connection.client_id << 32)
+        for node in self.scene.node_list:
+            self.on_scene_event('add', node)
+        self.scene.add_listener(self.on_scene_event)
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        try:
+            await asyncio.wait_for(self.connection.connect(self.host, self.port), CONNECT_TIMEOUT)
+        except Exception as error:
+            self.error = error
+            return
+        finally:
+            self.connected.set()
+        sender = asyncio.ensure_future(self.send_ticks())
+        try:
+            while True:
+                timestamp, records = await self.connection.receive()
+                if records:
+                    self.incoming.put(records)
+        finally:
+            sender.cancel()
+
+    async def send_ticks(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            with self.outgoing_lock:
+                records, self.outgoing = self.outgoing, dict()
+            if records:
+                self.connection.send(b''.join(records.values()))
+
+    def on_scene_event(self, event, node):
+        # imported meshes live in local files the other editors can't load
+        if node.shape not in SHAPE_CODES:
+            return
+        record = encode_delta(event, node)
+        with self.outgoing_lock:
+            self.outgoing[(EVENTS[event], node.node_id)] = record
+
+    def poll(self):
+        """ Apply the remote changes received so far, return their count """
+        count = 0
+        while True:
+            try:
+                records = self.incoming.get_nowait()
+            except queue.Empty:
+                return count
+            for op, node_id, record in iter_records(records):
+                apply_record(self.scene, op, record)
+                count += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a scene sync server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7420)
+    parser.add_argument('--tick', type=float, default=1.0 / 60)
+    args = parser.parse_args()
+
+    async def serve():
+        server = SyncServer(args.host, args.port, args.tick)
+        await server.start()
+        print(f"sync server on {args.host}:{server.port}")
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Load test for the scene sync server.
+
+Simulates many editors that each place a node and then drag it around in
+circles, sending one move delta per motion event. Reports delta throughput,
+how much the server coalesced, and the fan-out latency between a batch being
+flushed by the server and each editor receiving it.
+
+    python sync_loadtest.py --editors 300 --duration 10
+"""
+import argparse
+import asyncio
+import math
+import time
+
+import numpy
+
+from sync import (OP_ADD, OP_MOVE, RECORDS, SHAPE_CODES, SyncConnection,
+                  SyncServer, iter_records)
+
+
+class Editor(object):
+    """ A simulated user dragging one node """
+
+    def __init__(self, index, rate):
+        self.index = index
+        # motion events per second
+        self.rate = rate
+        self.connection = SyncConnection()
+        self.node_id = None
+        self.sent = 0
+        self.received = 0
+        self.latencies = []
+
+    async def run(self, host, port, duration):
+        await self.connection.connect(host, port)
+        self.node_id = self.connection.client_id << 32
+        self.connection.send(RECORDS[OP_ADD].pack(
+            OP_ADD, self.node_id, SHAPE_CODES['cube'], self.index % 10,
+            0.0, 0.0, 0.0, 1.0))
+        receiver = asyncio.ensure_future(self.receive())
+        radius = 1.0 + self.index % 7
+        step = 0
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            angle = step * 0.05 + self.index
+            self.connection.send(RECORDS[OP_MOVE].pack(
+                OP_MOVE, self.node_id, radius * math.cos(angle), 0.0,
+                radius * math.sin(angle)))
+            self.sent += 1
+            step += 1
+            await asyncio.sleep(1.0 / self.rate)
+        # let the last batches arrive before hanging up
+        await asyncio.sleep(0.2)
+        receiver.cancel()
+        self.connection.close()
+
+    async def receive(self):
+        while True:
+            timestamp, records = await self.connection.receive()
+            if timestamp is not None:
+                self.latencies.append(time.perf_counter() - timestamp)
+            self.received += sum(1 for _ in iter_records(records))
+
+
+async def run_load_test(editors, duration, rate, host, port, tick):
+    server = None
+    if port is None:
+        server = SyncServer(host, 0, tick)
+        await server.start()
+        port = server.port
+
+    clients = [Editor(i, rate) for i in range(editors)]
+    start = time.perf_counter()
+    await asyncio.gather(*(c.run(host, port, duration) for c in clients))
+    elapsed = time.perf_counter() - start
+    if server is not None:
+        await server.stop()
+    return clients, elapsed, server
+
+
+def report(clients, elapsed, server):
+    sent = sum(c.sent for c in clients)
+    received = sum(c.received for c in clients)
+    latencies = numpy.array([l for c in clients for l in c.latencies]) * 1000.0
+    print(f"editors            {len(clients)}")
+    print(f"elapsed            {elapsed:.2f} s")
+    print(f"deltas sent        {sent} ({sent / elapsed:.0f}/s)")
+    print(f"records delivered  {received} ({received / elapsed:.0f}/s)")
+    if server is not None:
+        stats = server.stats
+        ratio = stats['records_in'] / max(stats['records_out'], 1)
+        print(f"batches            {stats['batches']}")
+        print(f"coalescing         {ratio:.2f} deltas per broadcast record")
+        print(f"bytes broadcast    {stats['bytes_out']}")
+        print(f"dropped editors    {stats['dropped_clients']}")
+    if len(latencies):
+        p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99])
+        print(f"fan-out latency    p50 {p50:.2f} ms  p95 {p95:.2f} ms  "
+              f"p99 {p99:.2f} ms  max {latencies.max():.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the sync server")
+    parser.add_argument('--editors', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--rate', type=float, default=60.0,
+                        help="motion events per second per editor")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=None,
+                        help="existing server, an in-process one is started otherwise")
+    parser.add_argument('--tick', type=float, default=1.0 / 60)
+    args = parser.parse_args()
+
+    clients, elapsed, server = asyncio.run(run_load_test(
+        args.editors, args.duration, args.rate, args.host, args.port, args.tick))
+    report(clients, elapsed, server)
+
+
+if __name__ == "__main__":
+    main()
@@ -80,8 +80,9 @@ __docformat__ = 'restructuredtext'
 __version__ = '1.0'
 
 import math
-import OpenGL.GL as gl
-from OpenGL.GL import GLfloat
+from ctypes import c_float as GLfloat
+
+from backend import GL as gl
 
 
 # Some useful functions on vectors
@@ -162,9 +163,10 @@ class Trackball(object):
         self._x = 0.0
         self._y = 0.0
 
-    def drag_to (self, x, y, dx, dy):
+    def drag_to (self, x, y, dx, dy, viewport=None):
         ''' Move trackball view from x,y to x+dx,y+dy. '''
-        viewport = gl.glGetIntegerv(gl.GL_VIEWPORT)
+        if viewport is None:
+            viewport = gl.glGetIntegerv(gl.GL_VIEWPORT)
         width,height = float(viewport[2]), float(viewport[3])
         x  = (x*2.0 - width)/width
         dx = (2.*dx)/width
@@ -1,3 +1,5 @@
+import math
+
 import numpy
 
 def scaling(scale):
@@ -13,4 +15,25 @@ def translation(displacement):
     t[0, 3] = displacement[0]
     t[1, 3] = displacement[1]
     t[2, 3] = displacement[2]
-    return t
\ No newline at end of file
+    return t
+
+def perspective(fovy, aspect, near, far):
+    """ The projection matrix gluPerspective would build """
+    f = 1.0 / math.tan(math.radians(fovy) / 2.0)
+    p = numpy.zeros((4, 4))
+    p[0, 0] = f / aspect
+    p[1, 1] = f
+    p[2, 2] = (far + near) / (near - far)
+    p[2, 3] = 2.0 * far * near / (near - far)
+    p[3, 2] = -1.0
+    return p
+
+def unproject(x, y, z, inv_matrix, viewport):
+    """ Map window coordinates back through inv_matrix, like gluUnProject """
+    ndc = numpy.array([
+        (x - viewport[0]) * 2.0 / viewport[2] - 1.0,
+        (y - viewport[1]) * 2.0 / viewport[3] - 1.0,
+        2.0 * z - 1.0,
+        1.0])
+    p = inv_matrix.dot(ndc)
+    return p[:3] / p[3]
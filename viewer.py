@@ -1,48 +1,62 @@
-from OpenGL.GL import (
-    glEnable, glCullFace,
-    glDepthFunc, glLightfv,
-    glColorMaterial, glClearColor,glClear,
-    GL_LIGHT0, GL_BACK, GLfloat_4, GLfloat_3, GL_CULL_FACE, 
-    GL_DEPTH_TEST, GL_LESS, GL_POSITION, GL_SPOT_DIRECTION,
-    GL_FRONT_AND_BACK, GL_AMBIENT_AND_DIFFUSE, GL_COLOR_MATERIAL,
-    GL_LIGHTING,GL_COLOR_BUFFER_BIT, GL_DEPTH_BUFFER_BIT,
-    )
-from OpenGL.GLUT import (
-    glutMainLoop, glutInit,
-    glutInitWindowSize, glutCreateWindow,
-    glutInitDisplayMode, GLUT_SINGLE, GLUT_RGB,
-    glutDisplayFunc,
-    )
-
-from OpenGL import GL
-from OpenGL import GLUT
-from OpenGL import GLU
+from backend import GL, GLU, GLUT
+
+import atexit
+import time
 
 import numpy
 from numpy.linalg import norm, inv
 
+import queries
 from scene import Scene
 from node import Sphere, Cube, SnowFigure
 from interaction import Interaction
+from memory import MemoryMonitor
 from primitive import G_OBJ_PLANE
+import scatter
+from scheduler import FRAME_RATE, FrameScheduler, FrameStats
+from paging import FLUSH_INTERVAL
+from snapshot import AUTOSAVE_INTERVAL, Autosave
+from transformation import perspective, translation, unproject
+from sync import SyncClient
+
+# copies made by the duplicate key, and the space left between them
+DUPLICATE_COUNT = 4
+DUPLICATE_GAP = 0.5
+# distance between the nodes scattered by the scatter key
+SCATTER_SPACING = 2.0
 
 class Viewer(object):
 
-    def __init__(self):
+    def __init__(self, sample_scene=True):
         """Initialize the viewer"""
+        self.init_state()
         self.init_interface()
         self.init_opengl()
-        self.init_scene()
+        self.init_scene(sample_scene)
         self.init_interaction()
         init_primitives()
 
+    def init_state(self):
+        """Initialize the state every viewer has, with a window or without"""
+        # number of frames drawn so far
+        self.frames = 0
+        # called once the first frame is on screen
+        self.first_frame_callback = None
+        # SyncClient once connected to other editors
+        self.sync = None
+        # draw the frame time statistics over the scene
+        self.show_stats = False
+        # paces the redraws of a window, set by init_interaction
+        self.scheduler = None
+
     def init_interface(self):
         """Initialize the window and register the render function"""
-        glutInit()
-        glutInitWindowSize(640, 480)
-        glutCreateWindow("3D Modeller".encode('utf-8'))
-        glutInitDisplayMode(GLUT_SINGLE | GLUT_RGB)
-        glutDisplayFunc(self.render)
+        GLUT.glutInit()
+        GLUT.glutInitWindowSize(640, 480)
+        # the display mode only applies to windows created after it is set
+        GLUT.glutInitDisplayMode(GLUT.GLUT_DOUBLE | GLUT.GLUT_RGB | GLUT.GLUT_DEPTH)
+        GLUT.glutCreateWindow("3D Modeller".encode('utf-8'))
+        GLUT.glutDisplayFunc(self.render)
 
         print("interface")
 
@@ -51,25 +65,28 @@ class Viewer(object):
         self.inverseModelView = numpy.identity(4)
         self.modelView = numpy.identity(4)
 
-        glEnable(GL_CULL_FACE)
-        glCullFace(GL_BACK)
-        glEnable(GL_DEPTH_TEST)
-        glDepthFunc(GL_LESS)
+        GL.glEnable(GL.GL_CULL_FACE)
+        GL.glCullFace(GL.GL_BACK)
+        GL.glEnable(GL.GL_DEPTH_TEST)
+        GL.glDepthFunc(GL.GL_LESS)
 
-        glEnable(GL_LIGHT0)
-        glLightfv(GL_LIGHT0, GL_POSITION, GLfloat_4(0, 0, 1, 0))
-        glLightfv(GL_LIGHT0, GL_SPOT_DIRECTION, GLfloat_3(0, 0, -1))
+        GL.glEnable(GL.GL_LIGHT0)
+        GL.glLightfv(GL.GL_LIGHT0, GL.GL_POSITION, GL.GLfloat_4(0, 0, 1, 0))
+        GL.glLightfv(GL.GL_LIGHT0, GL.GL_SPOT_DIRECTION, GL.GLfloat_3(0, 0, -1))
 
-        glColorMaterial(GL_FRONT_AND_BACK, GL_AMBIENT_AND_DIFFUSE)
-        glEnable(GL_COLOR_MATERIAL)
-        glClearColor(0.4, 0.4, 0.4, 0.0)
+        GL.glColorMaterial(GL.GL_FRONT_AND_BACK, GL.GL_AMBIENT_AND_DIFFUSE)
+        GL.glEnable(GL.GL_COLOR_MATERIAL)
+        GL.glClearColor(0.4, 0.4, 0.4, 0.0)
 
         print("Open GL")
 
-    def init_scene(self):
+    def init_scene(self, sample_scene=True):
         """Initialize the scene object and initialize scene"""
         self.scene = Scene()
-        self.create_sample_scene()
+        # accounts for the memory of the scene and of this viewer
+        self.memory = MemoryMonitor(self.scene, self)
+        if sample_scene:
+            self.create_sample_scene()
 
         print("scene")
 
@@ -89,22 +106,34 @@ class Viewer(object):
         self.scene.add_node(hierarchical_node)
 
 
-    def init_interaction(self):
+    def init_interaction(self, headless=False):
         """init user interaction and callback"""
-        self.interaction = Interaction()
-        self.interaction = Interaction()
+        self.interaction = Interaction(headless)
         self.interaction.register_callback('pick', self.pick)
         self.interaction.register_callback('move', self.move)
+        self.interaction.register_callback('drop', self.drop)
         self.interaction.register_callback('place', self.place)
         self.interaction.register_callback('rotate_color', self.rotate_color)
         self.interaction.register_callback('scale', self.scale)
+        self.interaction.register_callback('toggle_stats', self.toggle_stats)
+        self.interaction.register_callback('duplicate', self.duplicate)
+        self.interaction.register_callback('scatter', self.scatter)
+        self.interaction.register_callback('remove', self.remove)
+        self.interaction.register_callback('memory_report', self.memory_report)
+        # redraws are paced by the scheduler, headless callers draw themselves
+        self.scheduler = None
+        if not headless:
+            self.scheduler = FrameScheduler(self)
+            self.interaction.on_redisplay = self.scheduler.request_redraw
+            self.scheduler.start()
         print("interaction")
 
     def render(self):
         """The render pass for the scene"""
+        start = time.perf_counter()
         self.init_view()
-        glEnable(GL_LIGHTING)
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        GL.glEnable(GL.GL_LIGHTING)
+        GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT)
 
         # Load the modelview
         GL.glMatrixMode(GL.GL_MODELVIEW)
@@ -114,25 +143,87 @@ class Viewer(object):
         GL.glTranslated(loc[0], loc[1], loc[2])
         GL.glMultMatrixf(self.interaction.trackball.matrix)
 
-        # Store the inverse of current modelview
-        currentModelView = numpy.array(GL.glGetFloatv(GL.GL_MODELVIEW_MATRIX))
-        self.modelView = numpy.transpose(currentModelView)
-        self.inverseModelView = inv(numpy.transpose(currentModelView))
+        # Store the current modelview and its inverse
+        self.update_modelview()
+        if self.scene.store is not None:
+            self.scene.update_paging(*self.camera())
 
-        # REnder scene tis will call render function 
-        # for each object
-        self.scene.render()
+        # REnder scene, the draw calls are sorted by GL state
+        self.scene.render(self.modelView, self.projection_matrix())
 
         # draw the grid
         GL.glDisable(GL.GL_LIGHTING)
         GL.glCallList(G_OBJ_PLANE)
         GL.glPopMatrix()
 
-        # flush the so the scene can be drawn
-        GL.glFlush()
+        if self.show_stats:
+            self.draw_stats()
+
+        # show the finished frame
+        GLUT.glutSwapBuffers()
+        if self.scheduler is not None:
+            self.scheduler.frame_drawn(start, time.perf_counter())
+
+        self.frames += 1
+        if self.frames == 1 and self.first_frame_callback is not None:
+            self.first_frame_callback()
 
         print("Render")
 
+    def draw_stats(self):
+        """Draw the frame time statistics in the top left corner"""
+        xSize, ySize = self.interaction.get_window_size()
+        GL.glMatrixMode(GL.GL_PROJECTION)
+        GL.glPushMatrix()
+        GL.glLoadIdentity()
+        GLU.gluOrtho2D(0, xSize, 0, ySize)
+        GL.glMatrixMode(GL.GL_MODELVIEW)
+        GL.glPushMatrix()
+        GL.glLoadIdentity()
+        GL.glDisable(GL.GL_DEPTH_TEST)
+        GL.glColor3f(1.0, 1.0, 1.0)
+        for row, line in enumerate(self.scheduler.stats.lines()):
+            GL.glRasterPos2i(8, ySize - 18 * (row + 1))
+            for character in line:
+                GLUT.glutBitmapCharacter(GLUT.GLUT_BITMAP_8_BY_13, ord(character))
+        GL.glEnable(GL.GL_DEPTH_TEST)
+        GL.glPopMatrix()
+        GL.glMatrixMode(GL.GL_PROJECTION)
+        GL.glPopMatrix()
+        GL.glMatrixMode(GL.GL_MODELVIEW)
+
+    def frame_stats(self):
+        """Frame time statistics of the recent frames, see FrameStats.summary"""
+        if self.scheduler is None:
+            # nothing is paced without a window
+            return FrameStats(1.0 / FRAME_RATE).summary()
+        return self.scheduler.stats.summary()
+
+    def toggle_stats(self):
+        if self.scheduler is None: return
+        self.show_stats = not self.show_stats
+
+    def update_modelview(self):
+        """Compute the modelview matrix render loads, without asking GL"""
+        loc = self.interaction.translation
+        rotation = numpy.transpose(numpy.reshape(self.interaction.trackball.matrix, (4, 4)))
+        self.modelView = numpy.dot(translation(loc), rotation)
+        self.inverseModelView = inv(self.modelView)
+
+    def camera(self):
+        """Return the world space position and unit view direction of the eye"""
+        # init_view puts the eye 15 units in front of the modelview origin
+        position = self.inverseModelView.dot([0, 0, 15, 1])[:3]
+        forward = self.inverseModelView.dot([0, 0, -1, 0])[:3]
+        return position, forward / norm(forward)
+
+    def projection_matrix(self):
+        """The projection matrix init_view loads"""
+        xSize, ySize = self.interaction.get_window_size()
+        aspect_ratio = float(xSize) / float(ySize)
+        return numpy.dot(perspective(70, aspect_ratio, 0.1, 1000.0),
+                         translation([0, 0, -15]))
+
     def init_view(self):
         """Initialize projection matrix"""
         xSize, ySize = GLUT.glutGet(GLUT.GLUT_WINDOW_WIDTH), GLUT.glutGet(GLUT.GLUT_WINDOW_HEIGHT)
@@ -156,14 +247,12 @@ class Viewer(object):
         Consumes: x, y coordinates of mouse on screen 
         Return: start, direction of the ray 
         """
-        self.init_view()
+        xSize, ySize = self.interaction.get_window_size()
+        inv_projection = inv(self.projection_matrix())
 
-        GL.glMatrixMode(GL.GL_MODELVIEW)
-        GL.glLoadIdentity()
-
-        # get two points on the line
-        start = numpy.array(GLU.gluUnProject(x, y, 0.001))
-        end = numpy.array(GLU.gluUnProject(x, y, 0.999))
+        # get two points on the line, unprojected with an identity modelview
+        start = unproject(x, y, 0.001, inv_projection, (0, 0, xSize, ySize))
+        end = unproject(x, y, 0.999, inv_projection, (0, 0, xSize, ySize))
 
         # convert points to rays
         direction = end - start
@@ -172,15 +261,50 @@ class Viewer(object):
         return (start , direction)
 
     def pick(self, x, y):
-        """Select an object in the scene"""
+        """Select an object in the scene, the ray test runs on a worker"""
         start, direction = self.get_ray(x, y)
-        self.scene.pick(start, direction, self.modelView)
+        # drop the old selection now so drags before the result move nothing
+        self.scene.clear_selection()
+
+        def picked(hit):
+            self.scene.select_hit(hit[0], hit[1], start, direction)
+        self.interaction.bus.submit('pick', queries.pick, picked,
+                                    self.scene.query_snapshot(), start, direction,
+                                    self.modelView)
+
+    def check_collisions(self, node, on_result):
+        """Find the nodes overlapping node, on a worker"""
+        self.interaction.bus.submit('collisions', queries.collisions, on_result,
+                                    self.scene.query_snapshot(), node)
 
     def move(self, x, y):
-        """ Execute a move command on the scene. """
+        """ Execute a move command on the scene, at most once per frame. """
+        if self.scheduler is not None:
+            self.scheduler.defer('move', self.move_now, x, y)
+        else:
+            self.move_now(x, y)
+
+    def move_now(self, x, y):
         start, direction = self.get_ray(x, y)
         self.scene.move_selected(start, direction, self.inverseModelView)
 
+    def drop(self, x, y):
+        """ Report what the selected node overlaps once a drag ends """
+        # after the last move of the drag, which may still be deferred
+        if self.scheduler is not None:
+            self.scheduler.defer('drop', self.drop_now)
+        else:
+            self.drop_now()
+
+    def drop_now(self):
+        node = self.scene.selected_root
+        if node is None: return
+
+        def collided(nodes):
+            if nodes:
+                print(f"{node} overlaps {', '.join(str(other) for other in nodes)}")
+        self.check_collisions(node, collided)
+
     def rotate_color(self, forward):
         """ 
         Rotate the color of the selected Node. 
@@ -197,8 +321,74 @@ class Viewer(object):
         start, direction = self.get_ray(x, y)
         self.scene.place(shape, start, direction, self.inverseModelView)
 
+    def duplicate(self):
+        """ Add a row of copies of the selected node beside it """
+        node = self.scene.selected_root
+        if node is None: return
+        step = 2.0 * node.aabb.size[0] + DUPLICATE_GAP
+        scatter.array(self.scene, node, scatter.linear_offsets(DUPLICATE_COUNT, [step, 0, 0]))
+
+    def scatter(self, count=None):
+        """
+        Scatter spheres and cubes on the ground, as Poisson disk samples over
+        the grid or, given a count, at random over an area sized to fit them
+        """
+        rng = numpy.random.default_rng()
+        if count is None:
+            extent = self.scene.GRID_EXTENT
+            locations = scatter.poisson_points(SCATTER_SPACING, [-extent, 0.5, -extent],
+                                               [extent, 0.5, extent], rng)
+        else:
+            extent = SCATTER_SPACING * numpy.sqrt(count) / 2.0
+            locations = scatter.random_points(count, [-extent, 0.5, -extent],
+                                              [extent, 0.5, extent], rng)
+        scatter.scatter(self.scene, locations, rng=rng)
+
+    def remove(self):
+        """ Delete the selected node """
+        self.scene.remove_selected()
+
+    def memory_report(self):
+        """ Print the memory used by each subsystem, and any leaked nodes """
+        print('\n'.join(self.memory.lines()))
+
+    def connect(self, host, port):
+        """ Share the scene with the other editors of a sync server """
+        # the scheduler applies their changes once per frame
+        self.sync = SyncClient(self.scene, host, port)
+        self.sync.start()
+
+    def start_autosave(self, directory):
+        """ Load the scene saved in directory, then keep saving changes to it """
+        self.autosave = Autosave(self.scene, directory)
+        self.autosave.load()
+        # the edits since the last timed save are saved on the way out
+        atexit.register(self.autosave.close)
+        GLUT.glutTimerFunc(int(AUTOSAVE_INTERVAL * 1000), self.run_autosave, 0)
+
+    def run_autosave(self, value):
+        # only the freeze runs here, the writing is done in the background
+        self.autosave.save()
+        GLUT.glutTimerFunc(int(AUTOSAVE_INTERVAL * 1000), self.run_autosave, 0)
+
+    def attach_store(self, store):
+        """ Page the nodes of a ChunkStore in and out, writing edits back as they are made """
+        self.scene.attach_store(store)
+        # edits to chunks still resident are written on the way out
+        atexit.register(store.close)
+        GLUT.glutTimerFunc(int(FLUSH_INTERVAL * 1000), self.run_flush, 0)
+
+    def run_flush(self, value):
+        self.scene.store.flush()
+        GLUT.glutTimerFunc(int(FLUSH_INTERVAL * 1000), self.run_flush, 0)
+
     def main_loop(self):
-        glutMainLoop()
+        # freeglut ends the process when the window closes, unless told to
+        # return, which lets the exit handlers run
+        if bool(GLUT.glutSetOption):
+            GLUT.glutSetOption(GLUT.GLUT_ACTION_ON_WINDOW_CLOSE,
+                               GLUT.GLUT_ACTION_GLUTMAINLOOP_RETURNS)
+        GLUT.glutMainLoop()
 
 def init_primitives():
     print("init primitive")
\ No newline at end of file